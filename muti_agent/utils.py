@@ -14,7 +14,9 @@ class ManiSkill2Dataset(Dataset):
         self.dataset_file = dataset_file
         # for details on how the code below works, see the
         # quick start tutorial
-        self.data = h5py.File(dataset_file, "r")
+        # only read while loading, an open handle kept on the dataset could not be
+        # shared with DataLoader workers
+        data = h5py.File(dataset_file, "r")
         json_path = dataset_file.replace(".h5", ".json")
         self.json_data = load_json(json_path)
         self.episodes = self.json_data["episodes"]
@@ -30,7 +32,7 @@ class ManiSkill2Dataset(Dataset):
             load_count = len(self.episodes)
         for eps_id in tqdm(range(load_count)):
             eps = self.episodes[eps_id]
-            trajectory = self.data[f"traj_{eps['episode_id']}"]
+            trajectory = data[f"traj_{eps['episode_id']}"]
             trajectory = self.load_h5_data(trajectory)
 
             # convert the original raw observation with our batch-aware function
@@ -40,6 +42,7 @@ class ManiSkill2Dataset(Dataset):
             self.obs_rgbd.append(obs['rgbd'][:-1])
             self.obs_state.append(obs['state'][:-1])
             self.actions.append(trajectory["actions"])
+        data.close()
 
     # loads h5 data into memory for faster access
     def load_h5_data(self, data):
@@ -0,0 +1,150 @@
+import queue
+import threading
+import numpy as np
+import torch
+from typing import Dict
+
+
+class BatchPrefetcher:
+    """Samples replay batches on a worker thread and moves them to the device ahead of use.
+
+    Each batch is copied into one of two pinned host staging sets and sent to the device with
+    non-blocking copies on a side CUDA stream, so sampling and host-to-device transfer overlap
+    with the update running on the previous batch. Priority updates are queued and applied to the
+    buffer right before the next batch is sampled, so they reach the sampling up to `prefetch + 1`
+    batches late. `store` calls from other threads must hold `lock` while the prefetcher is running.
+    Without a CUDA device there is no transfer to overlap and sampling directly is preferable.
+
+    Attributes:
+        buffer (PrioritizedReplayBuffer): buffer to sample from
+        device (torch.device): device the tensors are delivered on
+        lock (threading.Lock): guards the buffer against concurrent sampling and storing
+
+    """
+
+    def __init__(self, buffer, device: torch.device, prefetch: int = 1):
+        """Initialization.
+
+        Args:
+            buffer (PrioritizedReplayBuffer)
+            device (torch.device)
+            prefetch (int): number of batches sampled ahead
+
+        """
+        self.buffer = buffer
+        self.device = torch.device(device)
+        self.lock = threading.Lock()
+        self.use_cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._pending_priorities = []
+        self._staging = [None, None]
+        self._staging_events = [None, None]
+        self._staging_idx = 0
+        self._batch_out = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the worker thread if it is not running."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the worker thread, dropping any prefetched batch."""
+        self._stop.set()
+        # unblock a worker waiting on a full queue
+        while self._thread is not None and self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(timeout=0.1)
+        self._thread = None
+        self._stop.clear()
+
+    def update_priorities(self, indices: np.ndarray, priorities: np.ndarray):
+        """Queue a priority update, applied before the next batch is sampled."""
+        with self.lock:
+            self._pending_priorities.append((indices, priorities))
+
+    def next(self) -> Dict[str, torch.Tensor]:
+        """Return the next batch with every array except `indices` as a device tensor."""
+        self.start()
+        item = self._queue.get()
+        if isinstance(item, BaseException):
+            # the worker has exited, let the next call start a fresh one
+            self._thread.join()
+            self._thread = None
+            raise item
+
+        batch, event = item
+        if self.use_cuda:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    # the memory was allocated on the side stream but is consumed on this one
+                    value.record_stream(current_stream)
+        return batch
+
+    def _worker(self):
+        try:
+            while not self._stop.is_set():
+                with self.lock:
+                    for indices, priorities in self._pending_priorities:
+                        self.buffer.update_priorities(indices, priorities)
+                    self._pending_priorities.clear()
+                    batch = self._sample()
+                item = self._to_device(batch)
+
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except BaseException as e:
+            self._queue.put(e)
+
+    def _sample(self) -> Dict[str, np.ndarray]:
+        if not self.use_cuda:
+            # the CPU tensors share memory with the sampled arrays, so these cannot be reused
+            return self.buffer.sample_batch()
+
+        # the batch is copied into pinned staging memory before the next sample, so one set of outputs suffices
+        if self._batch_out is None:
+            self._batch_out = self.buffer.allocate_batch()
+        return self.buffer.sample_batch(out=self._batch_out)
+
+    def _to_device(self, batch: Dict[str, np.ndarray]):
+        """Copy a sampled batch into pinned staging memory and issue non-blocking device copies."""
+        if not self.use_cuda:
+            return {key: value if key == "indices" else torch.from_numpy(np.ascontiguousarray(value))
+                    for key, value in batch.items()}, None
+
+        # alternate staging sets so a set is only rewritten once its previous copy has finished
+        idx = self._staging_idx
+        self._staging_idx = 1 - idx
+        if self._staging_events[idx] is not None:
+            self._staging_events[idx].synchronize()
+        staging = self._staging[idx]
+        if staging is None or any(key not in staging or staging[key].shape != value.shape
+                                  for key, value in batch.items() if key != "indices"):
+            staging = {key: torch.from_numpy(np.empty(value.shape, dtype=value.dtype)).pin_memory()
+                       for key, value in batch.items() if key != "indices"}
+            self._staging[idx] = staging
+
+        out = dict(indices=batch["indices"])
+        with torch.cuda.stream(self.stream):
+            for key, value in batch.items():
+                if key == "indices":
+                    continue
+                staging[key].numpy()[...] = value
+                out[key] = staging[key].to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self._staging_events[idx] = event
+        return out, event
@@ -0,0 +1,67 @@
+import torch
+
+
+class ContextBuffer:
+    """Sliding window of the latest `capacity` embeddings, kept on the device.
+
+    Every entry is written twice, at `head` and at `head + capacity` of a storage twice the
+    capacity, so the window in time order is always one contiguous slice and appending costs two
+    row writes instead of shifting the whole window. Only appended entries are returned, so a
+    window that is not full yet is shorter instead of holding uninitialized rows.
+
+    With gradients enabled, entries keep their graph so a loss backpropagates through earlier
+    entries as with a concatenated window. Appends then write into a new storage instead of in
+    place, which would invalidate slices saved for the backward pass, and copy the storage like
+    concatenation did. Without gradients, as in rollouts, appends write in place.
+
+    Attributes:
+        capacity (int): maximum number of entries kept
+        length (int): number of valid entries
+        storage (torch.Tensor): [batch_size, 2 * capacity, dim]
+
+    """
+
+    def __init__(self, batch_size: int, capacity: int, dim: int, device: torch.device):
+        """Initialization.
+
+        Args:
+            batch_size (int)
+            capacity (int)
+            dim (int): size of each entry
+            device (torch.device)
+
+        """
+        self.capacity = capacity
+        self.storage = torch.zeros((batch_size, 2 * capacity, dim), device=device)
+        self.head = 0
+        self.length = 0
+
+    def append(self, x: torch.Tensor):
+        """Add `x` [batch_size, dim] as the newest entry, dropping the oldest one when full."""
+        if torch.is_grad_enabled():
+            index = torch.tensor([self.head, self.head + self.capacity], device=self.storage.device)
+            self.storage = self.storage.index_copy(1, index, x.unsqueeze(1).expand(-1, 2, -1).to(self.storage.dtype))
+        else:
+            if self.storage.requires_grad:
+                # the old storage may still be saved for a backward pass
+                self.storage = self.storage.detach().clone()
+            self.storage[:, self.head] = x
+            self.storage[:, self.head + self.capacity] = x
+        self.head = (self.head + 1) % self.capacity
+        self.length = min(self.length + 1, self.capacity)
+
+    def view(self) -> torch.Tensor:
+        """The valid entries, oldest first, as [batch_size, length, dim]."""
+        # the window ends at the second copy of the newest entry
+        end = (self.head - 1) % self.capacity + self.capacity + 1
+        return self.storage[:, end - self.length:end]
+
+    def reset(self):
+        """Forget every entry, the storage is overwritten by later appends."""
+        # release the graph of the previous entries
+        self.storage = self.storage.detach()
+        self.head = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
@@ -16,6 +16,7 @@ qbits = 8
 n_heads = 8
 d_model = 512
 sequence_length = 100
+vision_micro_batch_size = None  # frames per vision encoder pass over a sequence, None encodes them all at once
 
 # PPO parameters
 epsilon =  0.2 # clip parameter for PPO
@@ -35,6 +36,13 @@ lr=0.001
 grad_norm_clipping = 0.5
 beta = 0.01
 memory_size = int(1e3)
+compact_vision = False  # store RGB as uint8 and depth as uint16, about 4x less replay memory but quantized observations
+replay_memmap_dir = None  # directory for a disk-backed, resumable replay buffer
+prefetch_batches = True  # sample replay batches on a worker thread, only used on CUDA devices
+cache_vision_embeddings = False  # keep vision embeddings in the replay buffer while the encoder is not trained, re-embedding it on every switch to fine_tune
+replay_store_vision = True  # False keeps only the embeddings, needs cache_vision_embeddings and no replay_memmap_dir, and empties the buffer whenever the encoder is trained
+parallel_pretrain = False  # teacher-forced pre_train loss over all timesteps in one pass, trains the inputs get_action_step sees
+stateful_actor = False  # carry the actor state across control steps instead of re-running get_action, requires parallel_pretrain
 num_episodes = 100
 batch_size = 3
 num_workers = 0
@@ -1,44 +1,148 @@
-import random
+import os
+import copy
+import json
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
-from typing import Dict, List
+import torch
+from typing import Callable, Dict, List, Optional
 from segment_tree import MinSegmentTree, SumSegmentTree
 import parameters as params
 
 class ReplayBuffer:
-    """A simple numpy replay buffer."""
+    """A simple numpy replay buffer.
 
-    def __init__(self):
-        """Initialization."""
-        self.memory_size = params.memory_size
+    Each slot holds one sequence of `sequence_length` transitions. Frames are kept once, with
+    one extra terminal frame per slot, so `next_vision[t]` and `next_proprioception[t]` are read
+    back as frame `t + 1` of the same slot. This assumes consecutive `store` calls within a slot
+    continue the same trajectory, i.e. `vision` equals the previous call's `next_vision`.
+    Every store takes host (numpy) arrays; device tensors must be moved to the CPU first.
+
+    With `memmap_dir` set, every array is a `.npy` file memory-mapped from that directory and the
+    buffer position is saved next to them after each completed sequence, so constructing a buffer
+    on the same directory resumes where the previous run stopped.
+
+    With `embedding_dim` set, every frame can also carry its vision encoder embedding. A slot's
+    embeddings are valid once all of its frames have one, and `invalidate_embeddings` drops them
+    when the encoder changes. While `sample_embeddings` is set, batches hold `vision_embedding`
+    and `next_vision_embedding` instead of the frames, and every store must pass embeddings.
+    Without `store_vision` only the embeddings are kept, so `sample_embeddings` is always set.
+    """
+
+    def __init__(self, compact_vision: bool = False, memmap_dir: Optional[str] = None, capacity: Optional[int] = None,
+                 embedding_dim: Optional[int] = None, store_vision: bool = True):
+        """Initialization.
+
+        Args:
+            compact_vision (bool): keep RGB as uint8 and depth as uint16 instead of float32,
+                converting back to rescaled floats only for the sampled batch
+            memmap_dir (str): directory for on-disk arrays, None keeps everything in RAM
+            capacity (int): number of sequence slots, defaults to `params.memory_size`
+            embedding_dim (int): size of the cached vision embeddings, None disables the cache
+            store_vision (bool): keep the frames, False requires `embedding_dim` and no `memmap_dir`
+
+        """
+        self.memory_size = params.memory_size if capacity is None else capacity
         self.vision_dim = params.vision_dim
         self.proprioception_dim = params.proprioception_dim
         self.action_dim = params.action_dim
         self.batch_size = params.batch_size
         self.sequence_length = params.sequence_length    
+        self.compact_vision = compact_vision
+        assert store_vision or embedding_dim is not None, "a buffer without frames needs embeddings"
+        if memmap_dir is not None and not store_vision:
+            # a resumed buffer would hold embeddings from an encoder that has changed since, with no frames to redo them
+            raise ValueError("a memory-mapped buffer must store frames")
+        self.memmap_dir = memmap_dir
+        self._memmaps = []
+        if self.memmap_dir is not None:
+            os.makedirs(self.memmap_dir, exist_ok=True)
+        self.embedding_dim = embedding_dim
+        self.store_vision = store_vision
+        self.sample_embeddings = not store_vision
 
-        self.vision_buf = np.zeros([self.memory_size, self.sequence_length, *self.vision_dim], dtype=np.float32)
-        self.proprioception_buf = np.zeros([self.memory_size, self.sequence_length, self.proprioception_dim], dtype=np.float32)
+        # sequence_length + 1 frames per slot: the last one is the terminal next observation
+        if self.store_vision and self.compact_vision:
+            rgb_dim = (3, *self.vision_dim[1:])
+            depth_dim = (1, *self.vision_dim[1:])
+            self.vision_rgb_buf = self._allocate("vision_rgb_buf", [self.memory_size, self.sequence_length + 1, *rgb_dim], np.uint8)
+            self.vision_depth_buf = self._allocate("vision_depth_buf", [self.memory_size, self.sequence_length + 1, *depth_dim], np.uint16)
+        elif self.store_vision:
+            self.vision_buf = self._allocate("vision_buf", [self.memory_size, self.sequence_length + 1, *self.vision_dim], np.float32)
+        if self.embedding_dim is not None:
+            self.embedding_buf = self._allocate("embedding_buf", [self.memory_size, self.sequence_length + 1, self.embedding_dim], np.float32)
+            # whether every frame of a slot has an embedding from the current encoder
+            self.embedded_buf = self._allocate("embedded_buf", [self.memory_size], np.bool_)
 
-        self.next_vision_buf = np.zeros([self.memory_size, self.sequence_length, *self.vision_dim], dtype=np.float32)
-        self.next_proprioception_buf = np.zeros([self.memory_size, self.sequence_length, self.proprioception_dim], dtype=np.float32)
+        self.proprioception_buf = self._allocate("proprioception_buf", [self.memory_size, self.sequence_length + 1, self.proprioception_dim], np.float32)
 
-        self.action_buf = np.zeros([self.memory_size, self.sequence_length, self.action_dim], dtype=np.float32)
-        self.reward_buf = np.zeros([self.memory_size, self.sequence_length], dtype=np.float32)
-        self.done_buf = np.zeros([self.memory_size, self.sequence_length], dtype=np.float32)
+        self.action_buf = self._allocate("action_buf", [self.memory_size, self.sequence_length, self.action_dim], np.float32)
+        self.reward_buf = self._allocate("reward_buf", [self.memory_size, self.sequence_length], np.float32)
+        self.done_buf = self._allocate("done_buf", [self.memory_size, self.sequence_length], np.float32)
         self.max_size = self.memory_size
         self.ptr, self.size = 0, 0
         self.sequence_counter = 0
+        if self.memmap_dir is not None:
+            self._load_state()
+
+    def _allocate(self, name: str, shape, dtype, fill_value: float = 0) -> np.ndarray:
+        """Allocate a buffer array, memory-mapped from `memmap_dir` when one is set."""
+        if self.memmap_dir is None:
+            # np.zeros leaves untouched pages unallocated, np.full would commit them all
+            return np.zeros(shape, dtype=dtype) if fill_value == 0 else np.full(shape, fill_value, dtype=dtype)
+
+        path = os.path.join(self.memmap_dir, name + ".npy")
+        if os.path.exists(path):
+            array = np.lib.format.open_memmap(path, mode="r+")
+            if array.shape != tuple(shape) or array.dtype != dtype:
+                raise ValueError("{} holds {} {}, expected {} {}".format(
+                    path, array.shape, array.dtype, tuple(shape), np.dtype(dtype)))
+        else:
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+            if fill_value != 0:
+                array[...] = fill_value
+        self._memmaps.append(array)
+        return array
+
+    def _state_dict(self) -> Dict[str, int]:
+        """Buffer position needed to resume from memory-mapped arrays."""
+        return dict(ptr=self.ptr, size=self.size, sequence_counter=self.sequence_counter)
+
+    def _save_state(self):
+        """Atomically replace the saved buffer position."""
+        path = os.path.join(self.memmap_dir, "state.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self._state_dict(), f)
+        os.replace(path + ".tmp", path)
+
+    def _load_state(self):
+        """Restore the buffer position saved by a previous run, if any."""
+        path = os.path.join(self.memmap_dir, "state.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                for key, value in json.load(f).items():
+                    setattr(self, key, value)
 
+    def flush(self):
+        """Write memory-mapped arrays and the buffer position to disk."""
+        if self.memmap_dir is None:
+            return
+        for array in self._memmaps:
+            array.flush()
+        self._save_state()
         
     def store(self, vision: np.ndarray, proprioception: np.ndarray, action: np.ndarray, 
-              reward: np.ndarray, next_vision: np.ndarray, next_proprioception: np.ndarray, done: np.ndarray):
-        """Store experience to the buffer."""
+              reward: np.ndarray, next_vision: np.ndarray, next_proprioception: np.ndarray, done: np.ndarray,
+              vision_embedding: Optional[np.ndarray] = None, next_vision_embedding: Optional[np.ndarray] = None):
+        """Store experience to the buffer, `vision_embedding` is only used for a slot's first frame."""
+        self._check_embeddings(next_vision_embedding)
+        if self.sequence_counter == 0:
+            self._check_embeddings(vision_embedding)
         if self.sequence_counter < self.sequence_length:
-            self.vision_buf[self.ptr, self.sequence_counter] = vision
-            self.proprioception_buf[self.ptr, self.sequence_counter] = proprioception
-
-            self.next_vision_buf[self.ptr, self.sequence_counter] = next_vision
-            self.next_proprioception_buf[self.ptr, self.sequence_counter] = next_proprioception
+            # only the first frame of a slot is new, later ones were written as the previous next frame
+            if self.sequence_counter == 0:
+                self._store_frame(self.ptr, 0, vision, proprioception, vision_embedding)
+            self._store_frame(self.ptr, self.sequence_counter + 1, next_vision, next_proprioception, next_vision_embedding)
             
             self.action_buf[self.ptr, self.sequence_counter] = action
             self.reward_buf[self.ptr, self.sequence_counter] = reward
@@ -49,24 +153,236 @@ class ReplayBuffer:
                 self.sequence_counter = 0
                 self.ptr = (self.ptr + 1) % self.max_size
                 self.size = min(self.size + 1, self.max_size)    
+                if self.memmap_dir is not None:
+                    self._save_state()
+
+    def store_many(self, vision: np.ndarray, proprioception: np.ndarray, action: np.ndarray,
+                   reward: np.ndarray, done: np.ndarray, vision_embedding: Optional[np.ndarray] = None) -> np.ndarray:
+        """Store a whole trajectory, split into consecutive sequence slots with one write per array.
+
+        Args:
+            vision (np.ndarray): [length + 1, *vision_dim] observations including the terminal one
+            proprioception (np.ndarray): [length + 1, proprioception_dim]
+            action (np.ndarray): [length, action_dim]
+            reward (np.ndarray): [length]
+            done (np.ndarray): [length]
+            vision_embedding (np.ndarray): [length + 1, embedding_dim] embeddings of `vision`
+
+        Returns:
+            slots (np.ndarray): slots written, in trajectory order
+
+        """
+        assert self.sequence_counter == 0, "cannot store a trajectory while a sequence is being stored"
+        self._check_embeddings(vision_embedding)
+        sequences = self._split_sequences(vision, proprioception, action, reward, done, vision_embedding)
+        slots = (self.ptr + np.arange(len(sequences["action"]))) % self.max_size
+        self._write_sequences(slots, **sequences)
+
+        self.ptr = (self.ptr + len(slots)) % self.max_size
+        self.size = min(self.size + len(slots), self.max_size)
+        if self.memmap_dir is not None:
+            self._save_state()
+        return slots
+
+    def _split_sequences(self, vision: np.ndarray, proprioception: np.ndarray, action: np.ndarray,
+                         reward: np.ndarray, done: np.ndarray,
+                         vision_embedding: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """Cut a trajectory into `sequence_length` pieces, zero-padding the last one."""
+        length = len(action)
+        assert length > 0 and len(vision) == len(proprioception) == length + 1
+        starts = np.arange(0, length, self.sequence_length)
+        # only the most recent sequences survive when the trajectory is longer than the buffer
+        starts = starts[-self.max_size:]
+
+        steps = starts[:, None] + np.arange(self.sequence_length)
+        valid = steps < length
+        steps = np.minimum(steps, length - 1)
+        # a slot's last frame is the next one's first, frames after the terminal one are zero
+        frames = starts[:, None] + np.arange(self.sequence_length + 1)
+        valid_frames = frames <= length
+        frames = np.minimum(frames, length)
+        frame_mask = valid_frames.reshape(*valid_frames.shape, *[1] * (np.ndim(vision) - 1))
+
+        return dict(
+            # a buffer without frames skips the largest copy
+            frames=np.asarray(vision)[frames] * frame_mask if self.store_vision else None,
+            embedding_frames=None if vision_embedding is None else np.asarray(vision_embedding)[frames] * valid_frames[..., None],
+            proprioception_frames=np.asarray(proprioception)[frames] * valid_frames[..., None],
+            action=np.asarray(action)[steps] * valid[..., None],
+            reward=np.asarray(reward)[steps] * valid,
+            done=np.asarray(done)[steps] * valid,
+        )
 
-    def sample_batch(self) -> Dict[str, np.ndarray]:
+    def _write_sequences(self, slots: np.ndarray, frames: Optional[np.ndarray], embedding_frames: Optional[np.ndarray],
+                         proprioception_frames: np.ndarray, action: np.ndarray, reward: np.ndarray, done: np.ndarray):
+        """Write whole sequences into `slots`."""
+        if self.store_vision and self.compact_vision:
+            self.vision_rgb_buf[slots], self.vision_depth_buf[slots] = self._compress_vision(frames)
+        elif self.store_vision:
+            self.vision_buf[slots] = frames
+        if self.embedding_dim is not None:
+            if embedding_frames is not None:
+                self.embedding_buf[slots] = embedding_frames
+            self.embedded_buf[slots] = embedding_frames is not None
+        self.proprioception_buf[slots] = proprioception_frames
+        self.action_buf[slots] = action
+        self.reward_buf[slots] = reward
+        self.done_buf[slots] = done
 
+    def _store_frame(self, ptr: int, frame: int, vision: np.ndarray, proprioception: np.ndarray,
+                     embedding: Optional[np.ndarray] = None):
+        """Write one observation into frame `frame` of slot `ptr`."""
+        if self.store_vision and self.compact_vision:
+            self.vision_rgb_buf[ptr, frame], self.vision_depth_buf[ptr, frame] = self._compress_vision(vision)
+        elif self.store_vision:
+            self.vision_buf[ptr, frame] = vision
+        self.proprioception_buf[ptr, frame] = proprioception
+        if self.embedding_dim is not None:
+            # the first frame marks the slot embedded, any frame stored without one unmarks it
+            if embedding is not None:
+                self.embedding_buf[ptr, frame] = embedding
+            if frame == 0 or embedding is None:
+                self.embedded_buf[ptr] = embedding is not None
+
+    def _check_embeddings(self, embedding: Optional[np.ndarray]):
+        """Refuse to store a frame without its embedding while batches are sampled from embeddings."""
+        if embedding is None and self.sample_embeddings:
+            raise ValueError("vision embeddings are required while the buffer samples embeddings")
+
+    def missing_embeddings(self) -> np.ndarray:
+        """Stored slots that have no embeddings from the current encoder."""
+        return np.flatnonzero(~self.embedded_buf[:self.size])
+
+    def fill_embeddings(self, embed: Callable[[np.ndarray], np.ndarray], batch_size: Optional[int] = None):
+        """Embed the stored frames of every slot in `missing_embeddings`.
+
+        Args:
+            embed (function): maps float32 frames [n, sequence_length + 1, *vision_dim] to
+                embeddings [n, sequence_length + 1, embedding_dim]
+            batch_size (int): slots embedded per call, defaults to `batch_size`
+
+        """
+        assert self.store_vision, "a buffer without frames cannot compute embeddings"
+        batch_size = self.batch_size if batch_size is None else batch_size
+        missing = self.missing_embeddings()
+        for start in range(0, len(missing), batch_size):
+            slots = missing[start:start + batch_size]
+            self.embedding_buf[slots] = embed(self._gather_vision(slots, None))
+            self.embedded_buf[slots] = True
+
+    def invalidate_embeddings(self):
+        """Drop every cached embedding after the encoder changed.
+
+        A buffer without frames has nothing left to sample from, so it is emptied.
+        """
+        self.embedded_buf[...] = False
+        self.sample_embeddings = not self.store_vision
+        if not self.store_vision:
+            self.ptr, self.size, self.sequence_counter = 0, 0, 0
+            if self.memmap_dir is not None:
+                self._save_state()
+
+    def sample_batch(self, out: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+        """Sample a batch of sequences.
+
+        Args:
+            out (dict): arrays from `allocate_batch` to gather into instead of allocating new ones;
+                the returned arrays are views of them and are overwritten by the next call
+
+        """
         if self.size < self.batch_size:
             raise ValueError("Not enough entries in buffer to sample without replacement.")
     
         indices = np.random.choice(self.size, size=self.batch_size, replace=False)
         return dict(
-            vision = self.vision_buf[indices],
-            proprioception = self.proprioception_buf[indices],
-            next_vision = self.next_vision_buf[indices],
-            next_proprioception = self.next_proprioception_buf[indices],
-            action = self.action_buf[indices],
-            reward = self.reward_buf[indices],
-            done = self.done_buf[indices],
+            **self._gather(indices, out),
             indices=indices
         )
 
+    @property
+    def sample_length(self) -> int:
+        """Number of transitions in each sampled sequence."""
+        return self.sequence_length
+
+    def allocate_batch(self) -> Dict[str, np.ndarray]:
+        """Preallocate the arrays a batch is gathered into by `sample_batch(out=...)`."""
+        frames_shape = (self.batch_size, self.sample_length + 1)
+        out = dict(
+            proprioception_frames=np.empty((*frames_shape, self.proprioception_dim), dtype=np.float32),
+            action=np.empty((self.batch_size, self.sample_length, self.action_dim), dtype=np.float32),
+            reward=np.empty((self.batch_size, self.sample_length), dtype=np.float32),
+            done=np.empty((self.batch_size, self.sample_length), dtype=np.float32),
+        )
+        if self.embedding_dim is not None:
+            out.update(embedding_frames=np.empty((*frames_shape, self.embedding_dim), dtype=np.float32))
+        if self.store_vision:
+            out.update(vision_frames=np.empty((*frames_shape, *self.vision_dim), dtype=np.float32))
+        if self.store_vision and self.compact_vision:
+            out.update(
+                vision_rgb_frames=np.empty((*frames_shape, 3, *self.vision_dim[1:]), dtype=np.uint8),
+                vision_depth_frames=np.empty((*frames_shape, 1, *self.vision_dim[1:]), dtype=np.uint16),
+            )
+        return out
+
+    def _take(self, name: str, array: np.ndarray, indices: np.ndarray, out: Optional[Dict[str, np.ndarray]]) -> np.ndarray:
+        """Gather `array[indices]`, into `out[name]` when output arrays are given."""
+        if out is None:
+            return array[indices]
+        # mode="clip" skips the temporary copy np.take makes for bounds checking with out=,
+        # _gather checks the bounds once for all arrays instead of letting clip clamp them
+        return np.take(array, indices, axis=0, out=out[name], mode="clip")
+
+    def _gather_vision(self, indices: np.ndarray, out: Optional[Dict[str, np.ndarray]]) -> np.ndarray:
+        """Gather vision frames as a float32 array."""
+        if self.compact_vision:
+            return self._decompress_vision(self._take("vision_rgb_frames", self.vision_rgb_buf, indices, out),
+                                           self._take("vision_depth_frames", self.vision_depth_buf, indices, out),
+                                           out=None if out is None else out["vision_frames"])
+        return self._take("vision_frames", self.vision_buf, indices, out)
+
+    def _gather_frames(self, indices: np.ndarray, out: Optional[Dict[str, np.ndarray]]):
+        """Gather vision frames, or their embeddings while sampling embeddings, and proprioception frames."""
+        if self.sample_embeddings:
+            assert np.all(self.embedded_buf[indices]), "sampled slots without embeddings, call fill_embeddings first"
+            frames = self._take("embedding_frames", self.embedding_buf, indices, out)
+        else:
+            frames = self._gather_vision(indices, out)
+        proprioception_frames = self._take("proprioception_frames", self.proprioception_buf, indices, out)
+        return frames, proprioception_frames
+
+    def _gather(self, indices: np.ndarray, out: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+        """Gather the stored sequences at indices as float32 arrays."""
+        assert np.all((0 <= indices) & (indices < self.max_size)), "indices out of range: {}".format(indices)
+        frames, proprioception_frames = self._gather_frames(indices, out)
+        vision_key = "vision_embedding" if self.sample_embeddings else "vision"
+
+        # current and next observations are overlapping views of the same frames
+        return {
+            vision_key: frames[:, :-1],
+            "next_" + vision_key: frames[:, 1:],
+            "proprioception": proprioception_frames[:, :-1],
+            "next_proprioception": proprioception_frames[:, 1:],
+            "action": self._take("action", self.action_buf, indices, out),
+            "reward": self._take("reward", self.reward_buf, indices, out),
+            "done": self._take("done", self.done_buf, indices, out),
+        }
+
+    def _compress_vision(self, vision: np.ndarray):
+        """Quantize rescaled channel-first RGBD back to uint8 RGB and uint16 depth."""
+        vision = np.asarray(vision)
+        rgb = np.clip(np.rint(vision[..., 0:3, :, :] * 255.0), 0, 255).astype(np.uint8)
+        depth = np.clip(np.rint(vision[..., 3:4, :, :] * (2**10)), 0, 2**16 - 1).astype(np.uint16)
+        return rgb, depth
+
+    def _decompress_vision(self, rgb: np.ndarray, depth: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Rescale uint8 RGB and uint16 depth into a float32 channel-first RGBD array."""
+        vision = np.empty((*rgb.shape[:-3], 4, *rgb.shape[-2:]), dtype=np.float32) if out is None else out
+        vision[..., 0:3, :, :] = rgb
+        vision[..., 0:3, :, :] /= 255.0
+        vision[..., 3:4, :, :] = depth
+        vision[..., 3:4, :, :] /= 2**10
+        return vision
+
     def __len__(self) -> int:
         return self.size
     
@@ -75,7 +391,6 @@ class PrioritizedReplayBuffer(ReplayBuffer):
     
     Attributes:
         max_priority (float): max priority
-        tree_ptr (int): next index of tree
         alpha (float): alpha parameter for prioritized replay buffer
         sum_tree (SumSegmentTree): sum tree for prior
         min_tree (MinSegmentTree): min tree for min prior to get max weight
@@ -85,13 +400,20 @@ class PrioritizedReplayBuffer(ReplayBuffer):
     def __init__(
         self, 
         alpha: float = 0.6,
-        beta: float = 0.4
+        beta: float = 0.4,
+        compact_vision: bool = False,
+        memmap_dir: Optional[str] = None,
+        capacity: Optional[int] = None,
+        embedding_dim: Optional[int] = None,
+        store_vision: bool = True
     ):
         """Initialization."""
         assert alpha >= 0
         
-        super(PrioritizedReplayBuffer, self).__init__()
-        self.max_priority, self.tree_ptr = 1.0, 0
+        # set before the base class restores a saved state over them
+        self.max_priority = 1.0
+        super(PrioritizedReplayBuffer, self).__init__(compact_vision=compact_vision, memmap_dir=memmap_dir, capacity=capacity,
+                                                      embedding_dim=embedding_dim, store_vision=store_vision)
         self.alpha = alpha
         self.beta = beta
         
@@ -102,6 +424,14 @@ class PrioritizedReplayBuffer(ReplayBuffer):
 
         self.sum_tree = SumSegmentTree(tree_capacity)
         self.min_tree = MinSegmentTree(tree_capacity)
+        if self.memmap_dir is not None:
+            self.sum_tree.tree = self._allocate("sum_tree", self.sum_tree.tree.shape, np.float64)
+            self.min_tree.tree = self._allocate("min_tree", self.min_tree.tree.shape, np.float64, fill_value=float("inf"))
+
+    def _state_dict(self) -> Dict[str, float]:
+        state = super()._state_dict()
+        state.update(max_priority=self.max_priority)
+        return state
         
     def store(
         self, 
@@ -111,72 +441,330 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         reward: np.ndarray, 
         next_vision: np.ndarray, 
         next_proprioception: np.ndarray, 
-        done: np.ndarray
+        done: np.ndarray,
+        vision_embedding: Optional[np.ndarray] = None,
+        next_vision_embedding: Optional[np.ndarray] = None
     ):
         """Store experience and priority."""
+        # priorities are kept per slot, set when the slot's first transition arrives
+        if self.sequence_counter == 0:
+            self._check_embeddings(vision_embedding)
+            self._check_embeddings(next_vision_embedding)
+            self.sum_tree[self.ptr] = self.max_priority ** self.alpha
+            self.min_tree[self.ptr] = self.max_priority ** self.alpha
+
         super().store(vision, proprioception, action, 
-              reward, next_vision, next_proprioception, done)
+              reward, next_vision, next_proprioception, done, vision_embedding, next_vision_embedding)
+
+    def store_many(self, vision: np.ndarray, proprioception: np.ndarray, action: np.ndarray,
+                   reward: np.ndarray, done: np.ndarray, vision_embedding: Optional[np.ndarray] = None) -> np.ndarray:
+        """Store a whole trajectory, giving every new slot max priority in one tree update."""
+        slots = super().store_many(vision, proprioception, action, reward, done, vision_embedding)
+        self.sum_tree[slots] = self.max_priority ** self.alpha
+        self.min_tree[slots] = self.max_priority ** self.alpha
+        return slots
 
-        self.sum_tree[self.tree_ptr] = self.max_priority ** self.alpha
-        self.min_tree[self.tree_ptr] = self.max_priority ** self.alpha
-        self.tree_ptr = (self.tree_ptr + 1) % self.max_size
+    def invalidate_embeddings(self):
+        """Drop every cached embedding, clearing the priorities too when the buffer is emptied."""
+        super().invalidate_embeddings()
+        if not self.store_vision:
+            # in place, the trees may live in memory-mapped or shared arrays
+            self.sum_tree.tree[...] = 0.0
+            self.min_tree.tree[...] = float("inf")
+            self.max_priority = 1.0
 
-    def sample_batch(self) -> Dict[str, np.ndarray]:
-        """Sample a batch of experiences."""
+    def sample_batch(self, return_weights_as: str = "numpy", out: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+        """Sample a batch of experiences.
+
+        Args:
+            return_weights_as (str): "numpy" for a float32 array of importance weights,
+                "tensor" for a float32 tensor already on `params.device`
+            out (dict): see `ReplayBuffer.sample_batch`
+
+        """
         assert len(self) >= self.batch_size
         assert self.beta > 0
+        if return_weights_as not in ("numpy", "tensor"):
+            raise ValueError("return_weights_as must be 'numpy' or 'tensor', got {}".format(return_weights_as))
         
         indices = self._sample_proportional()
+        weights = self._calculate_weights(indices, self.beta)
+        if return_weights_as == "tensor":
+            weights = torch.from_numpy(weights).to(params.device)
         
         return dict(
-            vision = self.vision_buf[indices],
-            proprioception = self.proprioception_buf[indices],
-            next_vision = self.next_vision_buf[indices],
-            next_proprioception = self.next_proprioception_buf[indices],
-            action = self.action_buf[indices],
-            reward = self.reward_buf[indices],
-            done = self.done_buf[indices],
-            weights=np.array([self._calculate_weight(i, self.beta) for i in indices]),
+            **self._gather(indices, out),
+            weights=weights,
             indices=indices
         )
         
     def update_priorities(self, indices: List[int], priorities: np.ndarray):
         """Update priorities of sampled transitions."""
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        priorities = np.asarray(priorities, dtype=np.float64).reshape(-1)
         assert len(indices) == len(priorities)
+        if len(indices) == 0:
+            return
 
-        for idx, priority in zip(indices, priorities):
-            assert priority > 0
-            assert 0 <= idx < len(self)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= indices) & (indices < self.max_size))
+        # stored slots always have a positive priority, unwritten ones zero
+        assert np.all(self.sum_tree[indices] > 0), "priority update for a slot that holds no sequence"
 
-            self.sum_tree[idx] = priority ** self.alpha
-            self.min_tree[idx] = priority ** self.alpha
+        # both trees get the same leaves, so exponentiate once
+        priorities_alpha = priorities ** self.alpha
+        self.sum_tree[indices] = priorities_alpha
+        self.min_tree[indices] = priorities_alpha
 
-            self.max_priority = max(self.max_priority, priority)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
             
-    def _sample_proportional(self) -> List[int]:
+    def _sample_proportional(self) -> np.ndarray:
         """Sample indices based on proportions."""
-        indices = []
-        p_total = self.sum_tree.sum(0, len(self) - 1)
+        # slots without a sequence have zero priority and are never drawn, so sample the whole tree
+        p_total = self.sum_tree.sum()
         segment = p_total / self.batch_size
-        
-        for i in range(self.batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            upperbound = random.uniform(a, b)
-            idx = self.sum_tree.retrieve(upperbound)
-            indices.append(idx)
+
+        # one uniform draw inside each of the batch_size equal segments
+        upperbounds = (np.arange(self.batch_size) + np.random.uniform(size=self.batch_size)) * segment
+        indices = self.sum_tree.retrieve(upperbounds)
             
         return indices
     
-    def _calculate_weight(self, idx: int, beta: float):
-        """Calculate the weight of the experience at idx."""
+    def _calculate_weights(self, indices: np.ndarray, beta: float) -> np.ndarray:
+        """Calculate the weights of the experiences at indices."""
+        # read the root values once for the whole batch
+        p_total = self.sum_tree.sum()
+
         # get max weight
-        p_min = self.min_tree.min() / self.sum_tree.sum()
+        p_min = self.min_tree.min() / p_total
         max_weight = (p_min * len(self)) ** (-beta)
         
         # calculate weights
-        p_sample = self.sum_tree[idx] / self.sum_tree.sum()
-        weight = (p_sample * len(self)) ** (-beta)
-        weight = weight / max_weight
+        p_samples = self.sum_tree[indices] / p_total
+        weights = (p_samples * len(self)) ** (-beta)
+        weights = weights / max_weight
         
-        return weight
\ No newline at end of file
+        return weights.astype(np.float32)
+
+
+class SharedPrioritizedReplayBuffer(PrioritizedReplayBuffer):
+    """Prioritized replay buffer in shared memory, filled by several actor processes at once.
+
+    Every array, both segment trees and the buffer position live in
+    `multiprocessing.shared_memory` blocks. Passing the buffer to a child process (as a
+    `multiprocessing.Process` argument) attaches to the same blocks instead of copying them.
+    An actor claims a whole slot under the lock when it starts a sequence, fills it without
+    holding the lock, and publishes the slot's priority once the sequence ends. Claimed slots have
+    zero priority, so the learner never samples a sequence that is being written, and priority
+    updates for slots claimed since they were sampled are dropped. One process, the learner,
+    samples and updates priorities; the process that created the buffer must `unlink` it.
+
+    Attributes:
+        lock (multiprocessing.Lock): guards the trees and the buffer position
+        claimed_buf (np.ndarray): whether each slot is being written by an actor
+
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.6,
+        beta: float = 0.4,
+        compact_vision: bool = False,
+        capacity: Optional[int] = None,
+        embedding_dim: Optional[int] = None,
+        store_vision: bool = True
+    ):
+        """Initialization."""
+        self.lock = multiprocessing.Lock()
+        self._blocks = {}
+        self._specs = {}
+        # ptr, size and max_priority, shared through the properties below
+        self._shared_state = self._allocate("_shared_state", [3], np.float64)
+        super(SharedPrioritizedReplayBuffer, self).__init__(
+            alpha=alpha, beta=beta, compact_vision=compact_vision, capacity=capacity,
+            embedding_dim=embedding_dim, store_vision=store_vision)
+
+        self.sum_tree.tree = self._allocate("sum_tree", self.sum_tree.tree.shape, np.float64)
+        self.min_tree.tree = self._allocate("min_tree", self.min_tree.tree.shape, np.float64, fill_value=float("inf"))
+        self.claimed_buf = self._allocate("claimed_buf", [self.max_size], np.bool_)
+        self._owner = True
+        self._slot = 0
+
+    def _allocate(self, name: str, shape, dtype, fill_value: float = 0) -> np.ndarray:
+        """Allocate a buffer array in a new shared memory block."""
+        shape = tuple(shape)
+        nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        # new blocks are zero-filled
+        if fill_value != 0:
+            array[...] = fill_value
+        self._blocks[name] = block
+        self._specs[name] = (block.name, shape, np.dtype(dtype).str)
+        return array
+
+    @staticmethod
+    def _attach(block_name: str) -> shared_memory.SharedMemory:
+        """Attach to an existing block without letting this process's exit unlink it."""
+        try:
+            return shared_memory.SharedMemory(name=block_name, track=False)
+        except TypeError:
+            # Python < 3.13 always registers the block, but child processes share the creator's
+            # resource tracker, which already holds it and only cleans up when the creator exits
+            return shared_memory.SharedMemory(name=block_name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_blocks")
+        for name in self._specs:
+            if name in ("sum_tree", "min_tree"):
+                tree = copy.copy(state[name])
+                tree.tree = None
+                state[name] = tree
+            else:
+                state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks = {}
+        for name, (block_name, shape, dtype) in self._specs.items():
+            block = self._attach(block_name)
+            array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            self._blocks[name] = block
+            if name in ("sum_tree", "min_tree"):
+                getattr(self, name).tree = array
+            else:
+                setattr(self, name, array)
+        self._owner = False
+        self._slot = 0
+        self.sequence_counter = 0
+
+    @property
+    def ptr(self) -> int:
+        return int(self._shared_state[0])
+
+    @ptr.setter
+    def ptr(self, value: int):
+        self._shared_state[0] = value
+
+    @property
+    def size(self) -> int:
+        return int(self._shared_state[1])
+
+    @size.setter
+    def size(self, value: int):
+        self._shared_state[1] = value
+
+    @property
+    def max_priority(self) -> float:
+        return float(self._shared_state[2])
+
+    @max_priority.setter
+    def max_priority(self, value: float):
+        self._shared_state[2] = value
+
+    def store(
+        self,
+        vision: np.ndarray,
+        proprioception: np.ndarray,
+        action: np.ndarray,
+        reward: np.ndarray,
+        next_vision: np.ndarray,
+        next_proprioception: np.ndarray,
+        done: np.ndarray,
+        vision_embedding: Optional[np.ndarray] = None,
+        next_vision_embedding: Optional[np.ndarray] = None
+    ):
+        """Store experience, publishing the slot with max priority once its sequence ends."""
+        self._check_embeddings(next_vision_embedding)
+        if self.sequence_counter == 0:
+            self._check_embeddings(vision_embedding)
+            self._slot = self._claim_slots(1)[0]
+            self._store_frame(self._slot, 0, vision, proprioception, vision_embedding)
+        self._store_frame(self._slot, self.sequence_counter + 1, next_vision, next_proprioception, next_vision_embedding)
+
+        self.action_buf[self._slot, self.sequence_counter] = action
+        self.reward_buf[self._slot, self.sequence_counter] = reward
+        self.done_buf[self._slot, self.sequence_counter] = done
+        self.sequence_counter += 1
+
+        if done or self.sequence_counter == self.sequence_length:
+            self.sequence_counter = 0
+            self._publish_slots(np.array([self._slot]))
+
+    def store_many(self, vision: np.ndarray, proprioception: np.ndarray, action: np.ndarray,
+                   reward: np.ndarray, done: np.ndarray, vision_embedding: Optional[np.ndarray] = None) -> np.ndarray:
+        """Store a whole trajectory into slots claimed together and published together."""
+        assert self.sequence_counter == 0, "cannot store a trajectory while a sequence is being stored"
+        self._check_embeddings(vision_embedding)
+        sequences = self._split_sequences(vision, proprioception, action, reward, done, vision_embedding)
+        slots = self._claim_slots(len(sequences["action"]))
+        self._write_sequences(slots, **sequences)
+        self._publish_slots(slots)
+        return slots
+
+    def _claim_slots(self, count: int) -> np.ndarray:
+        """Take the next `count` slots for writing and remove them from sampling."""
+        with self.lock:
+            slots = (self.ptr + np.arange(count)) % self.max_size
+            self.ptr = (self.ptr + count) % self.max_size
+            self.claimed_buf[slots] = True
+            self.sum_tree[slots] = 0.0
+            self.min_tree[slots] = float("inf")
+        return slots
+
+    def _publish_slots(self, slots: np.ndarray):
+        """Make fully written slots available for sampling with max priority."""
+        with self.lock:
+            priority_alpha = self.max_priority ** self.alpha
+            self.sum_tree[slots] = priority_alpha
+            self.min_tree[slots] = priority_alpha
+            self.claimed_buf[slots] = False
+            self.size = min(self.size + len(slots), self.max_size)
+
+    def sample_batch(self, return_weights_as: str = "numpy", out: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+        """Sample a batch of experiences, holding the lock until the sequences are copied out."""
+        with self.lock:
+            return super(SharedPrioritizedReplayBuffer, self).sample_batch(return_weights_as, out)
+
+    def missing_embeddings(self) -> np.ndarray:
+        """Published slots that have no embeddings from the current encoder.
+
+        Slots are published in the order their writers finish, not the order they were claimed, so
+        the published ones are those with a positive priority rather than the first `size`.
+        """
+        with self.lock:
+            published = self.sum_tree[np.arange(self.max_size)] > 0
+            return np.flatnonzero(published & ~self.embedded_buf)
+
+    def invalidate_embeddings(self):
+        """Drop every cached embedding; actors must not be storing while a buffer without frames is emptied."""
+        with self.lock:
+            super(SharedPrioritizedReplayBuffer, self).invalidate_embeddings()
+
+    def update_priorities(self, indices: List[int], priorities: np.ndarray):
+        """Update priorities of sampled transitions, skipping slots claimed since sampling."""
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        priorities = np.asarray(priorities, dtype=np.float64).reshape(-1)
+        with self.lock:
+            keep = ~self.claimed_buf[indices]
+            super(SharedPrioritizedReplayBuffer, self).update_priorities(indices[keep], priorities[keep])
+
+    def close(self):
+        """Detach this process from the shared memory blocks."""
+        for name in self._specs:
+            if name in ("sum_tree", "min_tree"):
+                getattr(self, name).tree = None
+            else:
+                setattr(self, name, None)
+        for block in self._blocks.values():
+            block.close()
+        self._blocks = {}
+
+    def unlink(self):
+        """Detach and free the shared memory blocks; only the creating process may call this."""
+        assert self._owner, "only the process that created the buffer can unlink it"
+        for block in self._blocks.values():
+            block.unlink()
+        self.close()
@@ -1,10 +1,13 @@
+import contextlib
 import torch
 import torch.nn as nn
 from torch.nn.utils import clip_grad_norm_
 from prioritized_replay_buffer import PrioritizedReplayBuffer
+from batch_prefetcher import BatchPrefetcher
+from context_buffer import ContextBuffer
 from noise import OrnsteinUhlenbeckProcess
 import parameters as params
-from utils import convert_observation
+from utils import convert_observation, iter_demonstrations
 
 
 class PPO:
@@ -59,21 +62,18 @@ class PPO:
         self.rollout_length = params.rollout_length
         self.device = params.device
 
-        # Initialize sequential buffers as tensors
-        self.vision_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
-        self.pproprioception_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
-        self.action_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
+        # Initialize sequential buffers as device-side ring buffers
+        self.vision_buffer = ContextBuffer(1, self.sequence_length, params.d_model, self.device)
+        self.pproprioception_buffer = ContextBuffer(1, self.sequence_length, params.d_model, self.device)
+        self.action_buffer = ContextBuffer(1, self.sequence_length, params.d_model, self.device)
 
     def set_env(self, env):
         self.env = env
 
-    def update_seq_buffer(self, buffer, new_data):
-        return torch.cat((buffer[:, 1:, :], new_data.unsqueeze(1) ), dim=1)
-    
     def clear_seq_buffer(self):
-        self.vision_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
-        self.pproprioception_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
-        self.action_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
+        self.vision_buffer.reset()
+        self.pproprioception_buffer.reset()
+        self.action_buffer.reset()
 
     def compute_rtgs(self, reward_batch):
         rtgs_batch = torch.zeros_like(reward_batch)
@@ -85,6 +85,7 @@ class PPO:
 
         return rtgs_batch
     
+    @torch.no_grad()
     def rollout_storage(self, goal):
 
         # roll-out storage
@@ -99,8 +100,8 @@ class PPO:
         vision, proprioception = convert_observation(observation)
 
         # Add batch dimension
-        proprioception = torch.FloatTensor(proprioception).unsqueeze(0).to(self.device)
-        vision = torch.FloatTensor(vision).unsqueeze(0).to(self.device)
+        proprioception = proprioception.unsqueeze(0)
+        vision = vision.unsqueeze(0)
 
         self.clear_seq_buffer()
         for i in range(self.rollout_length):
@@ -109,18 +110,18 @@ class PPO:
             proprioception_embedded = self.embedding.proprioception_embed(proprioception)
             goal_embedded = self.embedding.vision_embed(goal)
 
-            self.vision_buffer = self.update_seq_buffer(self.vision_buffer, vision_embedded)
-            self.pproprioception_buffer = self.update_seq_buffer(self.pproprioception_buffer, proprioception_embedded)
+            self.vision_buffer.append(vision_embedded)
+            self.pproprioception_buffer.append(proprioception_embedded)
             
             latent = self.plan_proposal(vision_embedded, proprioception_embedded, goal_embedded).sample()
-            action, _ = self.actor.get_action(self.vision_buffer, self.pproprioception_buffer, latent, goal_embedded)
+            action, _ = self.actor.get_action(self.vision_buffer.view(), self.pproprioception_buffer.view(), latent, goal_embedded)
 
             observation, reward, done, truncated, info = self.env.step(action[0].detach().cpu().numpy())
             vision, proprioception = convert_observation(observation)
 
             # Add batch dimension
-            proprioception = torch.FloatTensor(proprioception).unsqueeze(0).to(self.device)
-            vision = torch.FloatTensor(vision).unsqueeze(0).to(self.device)
+            proprioception = proprioception.unsqueeze(0)
+            vision = vision.unsqueeze(0)
 
             vision_batch[0, i] = vision
             proprioception_batch[0, i] = proprioception
@@ -143,13 +144,14 @@ class PPO:
         action_embedded = self.embedding.action_embed(action)
         goal_embedded = self.embedding.vision_embed(goal)
 
-        self.vision_buffer = self.update_seq_buffer(self.vision_buffer, vision_embedded)
-        self.pproprioception_buffer = self.update_seq_buffer(self.pproprioception_buffer, proprioception_embedded)
+        self.vision_buffer.append(vision_embedded)
+        self.pproprioception_buffer.append(proprioception_embedded)
         
         latent = self.plan_proposal(vision_embedded, proprioception_embedded, goal_embedded).sample()
-        action, action_log_prob = self.actor.get_action(self.vision_buffer, self.pproprioception_buffer, latent, goal_embedded, self.action_buffer)
+        action, action_log_prob = self.actor.get_action(self.vision_buffer.view(), self.pproprioception_buffer.view(), latent,
+                                                        goal_embedded, self.action_buffer.view())
         action_embedded = self.embedding.action_embed(action)
-        self.action_buffer = self.update_seq_buffer(self.action_buffer, action_embedded)
+        self.action_buffer.append(action_embedded)
 
         value = self.critic(vision_embedded, proprioception_embedded, action_embedded)
 
@@ -208,7 +210,14 @@ class TargetRL:
         self.target_critic = target_critic
         self.actor_optimizer = actor_optimizer
         self.critic_optimizer = critic_optimizer   
-        self.pri_buffer = PrioritizedReplayBuffer(alpha=0.6, beta=0.4) 
+        self.cache_vision_embeddings = params.cache_vision_embeddings
+        self.pri_buffer = PrioritizedReplayBuffer(alpha=0.6, beta=0.4, compact_vision=params.compact_vision,
+                                                  memmap_dir=params.replay_memmap_dir,
+                                                  embedding_dim=params.d_model if self.cache_vision_embeddings else None,
+                                                  store_vision=params.replay_store_vision)
+        if self.cache_vision_embeddings and self.pri_buffer.store_vision:
+            # embeddings restored from replay_memmap_dir may come from another encoder
+            self.pri_buffer.invalidate_embeddings()
         self.noise = OrnsteinUhlenbeckProcess(size=params.action_dim)
         self.mse_loss = torch.nn.MSELoss()
         self.target_tau = target_tau
@@ -217,45 +226,118 @@ class TargetRL:
         self.device = params.device
         self.sequence_length = params.sequence_length
         self.bacth_size = params.batch_size 
+        # on the CPU there is no host-to-device copy to overlap, prefetching would only delay priority updates
+        use_prefetcher = params.prefetch_batches and torch.device(self.device).type == "cuda"
+        self.prefetcher = BatchPrefetcher(self.pri_buffer, self.device) if use_prefetcher else None
+        self.batch_out = None
+
+        # Initialize sequential buffers as device-side ring buffers
+        self.vision_buffer = ContextBuffer(self.bacth_size, self.sequence_length, params.d_model, self.device)
+        self.pproprioception_buffer = ContextBuffer(self.bacth_size, self.sequence_length, params.d_model, self.device)
+        self.action_buffer = ContextBuffer(self.bacth_size, self.sequence_length, params.d_model, self.device)
 
-        # Initialize sequential buffers as tensors
-        self.vision_buffer = torch.empty((self.bacth_size, self.sequence_length, params.d_model)).to(self.device)
-        self.pproprioception_buffer = torch.empty((self.bacth_size, self.sequence_length, params.d_model)).to(self.device)
-        self.action_buffer = torch.empty((self.bacth_size, self.sequence_length, params.d_model)).to(self.device)
+    def buffer_lock(self):
+        """Lock to hold while changing the buffer, a no-op without the prefetcher."""
+        return self.prefetcher.lock if self.prefetcher is not None else contextlib.nullcontext()
 
     def store_buffer(self, vision, proprioception, action, reward, next_vision, next_proprioception, done):
-        self.pri_buffer.store(vision, proprioception, action, reward, next_vision, next_proprioception, done)
+        # convert_observation returns device tensors, the replay buffer only stores host arrays
+        vision, proprioception, action, reward, next_vision, next_proprioception, done = [
+            value.detach().cpu().numpy() if torch.is_tensor(value) else value
+            for value in (vision, proprioception, action, reward, next_vision, next_proprioception, done)]
+        vision_embedding, next_vision_embedding = None, None
+        if self.pri_buffer.sample_embeddings:
+            frames = torch.stack((torch.as_tensor(vision), torch.as_tensor(next_vision)))
+            vision_embedding, next_vision_embedding = self.embed_frames(frames.unsqueeze(0))[0]
+        with self.buffer_lock():
+            self.pri_buffer.store(vision, proprioception, action, reward, next_vision, next_proprioception, done,
+                                  vision_embedding, next_vision_embedding)
+
+    def store_demonstrations(self, dataset_file, load_count=-1):
+        """Seed the buffer with whole demonstration episodes from a ManiSkill .h5/.json pair."""
+        for vision, proprioception, action, reward, done in iter_demonstrations(dataset_file, load_count):
+            vision_embedding = self.embed_frames(vision[None])[0] if self.pri_buffer.sample_embeddings else None
+            with self.buffer_lock():
+                self.pri_buffer.store_many(vision, proprioception, action, reward, done, vision_embedding)
+
+    def embed_frames(self, frames):
+        """Embed frames [B, T, *vision_dim] into a numpy array [B, T, d_model] for the replay buffer."""
+        with torch.no_grad():
+            frames = torch.as_tensor(frames, dtype=torch.float32, device=self.device)
+            return self.embedding.vision_embed_sequence(frames).cpu().numpy()
+
+    def freeze_encoder(self):
+        """Cache vision embeddings in the replay buffer until `unfreeze_encoder` is called.
+
+        Sequences already stored are embedded here and new ones when they are stored, so batches
+        carry embeddings instead of frames. The encoder must not be trained in the meantime.
+        """
+        if not self.cache_vision_embeddings or self.pri_buffer.sample_embeddings:
+            return
+        if self.prefetcher is not None:
+            # drop batches of frames sampled before the switch
+            self.prefetcher.stop()
+        self.embedding.eval()
+        with self.buffer_lock():
+            self.pri_buffer.fill_embeddings(self.embed_frames)
+            self.pri_buffer.sample_embeddings = True
+
+    def unfreeze_encoder(self):
+        """Invalidate the cached embeddings before the encoder is trained again."""
+        if not self.cache_vision_embeddings:
+            return
+        if self.prefetcher is not None:
+            # drop batches of embeddings from the old encoder
+            self.prefetcher.stop()
+        with self.buffer_lock():
+            self.pri_buffer.invalidate_embeddings()
+
+    def sample_batch(self):
+        """Sample a batch as device tensors, from the prefetcher when it is enabled."""
+        if self.prefetcher is not None:
+            return self.prefetcher.next()
+
+        # a batch is only used within one update_model call, so the same outputs can be reused every step
+        if self.batch_out is None:
+            self.batch_out = self.pri_buffer.allocate_batch()
+        buffer = self.pri_buffer.sample_batch(out=self.batch_out)
+        return {key: value if key == 'indices' else torch.FloatTensor(value).to(self.device) for key, value in buffer.items()}
+
+    def update_priorities(self, indices, priorities):
+        if self.prefetcher is not None:
+            self.prefetcher.update_priorities(indices, priorities)
+        else:
+            self.pri_buffer.update_priorities(indices, priorities)
 
 
-    def update_seq_buffer(self, buffer, new_data):
-        return torch.cat((buffer[:, 1:, :], new_data.unsqueeze(1) ), dim=1)
+    def clear_seq_buffer(self):
+        self.vision_buffer.reset()
+        self.pproprioception_buffer.reset()
+        self.action_buffer.reset()
 
     def get_next_action(self, vision_embedded, proprioception_embedded, goal_embedded, greedy=True):
     
         proposal_dist = self.plan_proposal(vision_embedded, proprioception_embedded, goal_embedded)
         proposal_latent = proposal_dist.sample()
 
-        self.vision_buffer = self.update_seq_buffer(self.vision_buffer, vision_embedded)
-        self.pproprioception_buffer = self.update_seq_buffer(self.pproprioception_buffer, proprioception_embedded)
-        next_action, _ = self.target_actor.get_action(self.vision_buffer, self.pproprioception_buffer, proposal_latent, goal_embedded, self.action_buffer)
+        self.vision_buffer.append(vision_embedded)
+        self.pproprioception_buffer.append(proprioception_embedded)
+        next_action, _ = self.target_actor.get_action(self.vision_buffer.view(), self.pproprioception_buffer.view(), proposal_latent,
+                                                      goal_embedded, self.action_buffer.view())
 
         next_action_embedded = self.embedding.action_embed(next_action)
-        self.action_buffer = self.update_seq_buffer(self.action_buffer, next_action_embedded)
+        self.action_buffer.append(next_action_embedded)
 
         if not greedy:
             next_action += torch.tensor(self.noise.sample(),dtype=torch.float).to(self.device)
         return next_action
     
-    def td_target(self, vision, next_vision, proprioception, 
-                    next_proprioception, action, goal, reward, done):
-
+    def td_target(self, vision_embedded, next_vision_embedded, proprioception, 
+                    next_proprioception, action, goal_embedded, reward, done):
 
-        vision_embedded = self.embedding.vision_embed(vision)
-        next_vision_embedded = self.embedding.vision_embed(next_vision)
         proprioception_embedded = self.embedding.proprioception_embed(proprioception)
         next_proprioception_embedded = self.embedding.proprioception_embed(next_proprioception)
         action_embedded = self.embedding.action_embed(action)
-        goal_embedded = self.embedding.vision_embed(goal)
 
         current_q = self.critic(vision_embedded, proprioception_embedded, action_embedded)
 
@@ -269,6 +351,18 @@ class TargetRL:
 
         return td_errors, critic_loss
 
+    def vision_embeddings(self, buffer):
+        """Embeddings of a batch's current and next frames, read from the buffer when it caches them."""
+        if 'vision_embedding' in buffer:
+            return buffer['vision_embedding'], buffer['next_vision_embedding']
+
+        # the encoder is not trained here, and next frames are the current ones shifted by one,
+        # so every frame is embedded once
+        with torch.no_grad():
+            frames = torch.cat((buffer['vision'], buffer['next_vision'][:, -1:]), dim=1)
+            frames_embedded = self.embedding.vision_embed_sequence(frames)
+        return frames_embedded[:, :-1], frames_embedded[:, 1:]
+
     def update_model(self, goal):
 
         self.embedding.eval()
@@ -276,24 +370,18 @@ class TargetRL:
         self.actor.train()
         self.critic.train()
 
-        buffer = self.pri_buffer.sample_batch()
-        vision, proprioception, next_vision, next_proprioception, action, reward, done, weights, indices = buffer['vision'], \
-        buffer['proprioception'], buffer['next_vision'], buffer['next_proprioception'], buffer['action'], buffer['reward'], \
-            buffer['done'], buffer['weights'], buffer['indices']
+        buffer = self.sample_batch()
+        proprioception, next_proprioception, action, reward, done, weights, indices = buffer['proprioception'], \
+            buffer['next_proprioception'], buffer['action'], buffer['reward'], buffer['done'], buffer['weights'], buffer['indices']
+        vision_embedded, next_vision_embedded = self.vision_embeddings(buffer)
 
-        vision = torch.FloatTensor(vision).to(self.device)
-        proprioception = torch.FloatTensor(proprioception).to(self.device)
-        next_vision = torch.FloatTensor(next_vision).to(self.device)
-        next_proprioception = torch.FloatTensor(next_proprioception).to(self.device)
-        action = torch.FloatTensor(action).to(self.device)
-        reward = torch.FloatTensor(reward).to(self.device)
-        done = torch.FloatTensor(done).to(self.device)
-        goal = goal.repeat(vision.shape[0], 1, 1, 1)  
+        with torch.no_grad():
+            goal_embedded = self.embedding.vision_embed(goal).expand(vision_embedded.shape[0], -1)
 
         td_errors, critic_losses, actor_losses = 0, 0, 0
         for i in range(self.sequence_length):            
-            td_error, critic_loss = self.td_target(vision[:, i, :, :, :], next_vision[:, i, :, :, :], proprioception[:, i, :],
-                                                next_proprioception[:, i, :], action[:, i, :], goal, reward[:, i], done[:, i])
+            td_error, critic_loss = self.td_target(vision_embedded[:, i, :], next_vision_embedded[:, i, :], proprioception[:, i, :],
+                                                next_proprioception[:, i, :], action[:, i, :], goal_embedded, reward[:, i], done[:, i])
                       
             td_errors += td_error
             critic_losses += critic_loss       
@@ -302,7 +390,7 @@ class TargetRL:
         critic_losses /= self.sequence_length
 
         """ Update priorities based on TD errors """
-        self.pri_buffer.update_priorities(indices, td_errors.detach().cpu().numpy())
+        self.update_priorities(indices, td_errors.detach().cpu().numpy())
 
         """ Update critic """
         self.critic_optimizer.zero_grad()
@@ -311,10 +399,9 @@ class TargetRL:
         self.critic_optimizer.step()
 
         for i in range(self.sequence_length):
-            vision_embedded = self.embedding.vision_embed(vision[:, i, :, :, :])
             proprioception_embedded = self.embedding.proprioception_embed(proprioception[:, i, :])
             action_embedded = self.embedding.action_embed(action[:, i, :])
-            actor_loss = -self.critic(vision_embedded, proprioception_embedded, action_embedded).mean()
+            actor_loss = -self.critic(vision_embedded[:, i, :], proprioception_embedded, action_embedded).mean()
             actor_losses += actor_loss  
                     
         actor_losses /= self.sequence_length
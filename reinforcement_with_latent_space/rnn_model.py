@@ -2,12 +2,32 @@ import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.distributions import Normal
 from torch.distributions import Categorical, Distribution, AffineTransform, TransformedDistribution, SigmoidTransform
 from torch.distributions.mixture_same_family import MixtureSameFamily
 from torch.distributions.uniform import Uniform
 import parameters as params
 
+def cell_states(lstm, x, h):
+    """
+    Cell states at every step of a one-layer batch_first LSTM started from zero states, recomputed
+    from its inputs x (bs, n, input_size) and outputs h (bs, n, hidden_size), since nn.LSTM only
+    returns the last one. The gates come from two matmuls, only the elementwise update is sequential.
+    """
+    h_prev = F.pad(h[:, :-1, :], (0, 0, 1, 0))
+    gates = F.linear(x, lstm.weight_ih_l0, lstm.bias_ih_l0) + F.linear(h_prev, lstm.weight_hh_l0, lstm.bias_hh_l0)
+    input_gate, forget_gate, cell_gate, _ = gates.chunk(4, dim=-1)
+    input_cell = torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+    forget_gate = torch.sigmoid(forget_gate)
+
+    c = torch.zeros_like(h[:, 0, :])
+    cells = []
+    for t in range(x.shape[1]):
+        c = forget_gate[:, t] * c + input_cell[:, t]
+        cells.append(c)
+    return torch.stack(cells, dim=1)
+
 def init_lstm(lstm):
     # Initialize the gates
     for name, param in lstm.named_parameters():
@@ -69,28 +89,31 @@ class VisionNetwork(nn.Module):
                                     nn.ReLU(),
                                     nn.Linear(512, self.out_dim))
 
-    def _spatial_softmax(self, pre_softmax):
-        N, C, H, W = pre_softmax.shape
-        pre_softmax = pre_softmax.view(N*C, H * W)
-        softmax = F.softmax(pre_softmax, dim=1)
-        softmax = softmax.view(N, C, H, W)
+        # [H*W, 2] spatial softmax grid, other feature map sizes get theirs on first use
+        self.register_buffer("image_coords", self._image_coords(H, W), persistent=False)
+        self.extra_image_coords = {}
 
-        # Create normalized meshgrid
-        x_coords = torch.linspace(0, 1, W, device=self.device)
-        y_coords = torch.linspace(0, 1, H, device=self.device)
+    def _image_coords(self, H, W, device=None):
+        x_coords = torch.linspace(0, 1, W, device=device)
+        y_coords = torch.linspace(0, 1, H, device=device)
         X, Y = torch.meshgrid(x_coords, y_coords, indexing='xy')
-        image_coords = torch.stack([X, Y], dim=-1).to(self.device)  # [H, W, 2]
+        return torch.stack([X, Y], dim=-1).view(H * W, 2)
 
-        image_coords = image_coords.unsqueeze(0)  # [1, H, W, 2]
-        image_coords = image_coords.unsqueeze(0)  # [1, H, W, 2] -> [1, 1, H, W, 2]
+    def _spatial_softmax(self, pre_softmax):
+        N, C, H, W = pre_softmax.shape
+        softmax = F.softmax(pre_softmax.reshape(N, C, H * W), dim=-1)
 
-        # Reshape softmax for broadcasting
-        softmax = softmax.unsqueeze(-1)  # [N, C, H, W, 1]
+        image_coords = self.image_coords
+        if image_coords.shape[0] != H * W or image_coords.device != softmax.device:
+            key = (H, W, softmax.device)
+            if key not in self.extra_image_coords:
+                self.extra_image_coords[key] = self._image_coords(H, W, softmax.device)
+            image_coords = self.extra_image_coords[key]
 
         # Compute spatial soft argmax
         # This tensor represents the 'center of mass' for each channel of each feature map in the batch
-        spatial_soft_argmax = torch.sum(softmax * image_coords, dim=[2, 3])  # [N, C, 2]
-        x = nn.Flatten()(spatial_soft_argmax)  # [N, C, 2] -> [N, 2*C]
+        spatial_soft_argmax = torch.matmul(softmax, image_coords.to(softmax.dtype))  # [N, C, 2]
+        x = spatial_soft_argmax.reshape(N, 2 * C)  # [N, C, 2] -> [N, 2*C]
         return x
 
     def forward(self, x):
@@ -99,6 +122,23 @@ class VisionNetwork(nn.Module):
         x = self.fc(spatial_soft_argmax)
         return x
 
+    def forward_sequence(self, x, micro_batch_size=None):
+        """
+        Encode a [B, T, C, H, W] sequence of frames into [B, T, out_dim].
+        Time is folded into the batch so every frame goes through one pass, or through passes of
+        `micro_batch_size` frames that are recomputed in backward to cap activation memory.
+        """
+        B, T = x.shape[:2]
+        frames = x.reshape(B * T, *x.shape[2:])
+        if micro_batch_size is None or micro_batch_size >= B * T:
+            out = self.forward(frames)
+        elif torch.is_grad_enabled():
+            out = torch.cat([checkpoint(self.forward, chunk, use_reentrant=False)
+                             for chunk in frames.split(micro_batch_size)], dim=0)
+        else:
+            out = torch.cat([self.forward(chunk) for chunk in frames.split(micro_batch_size)], dim=0)
+        return out.view(B, T, -1)
+
 
 class EmbeddingNetwork(nn.Module):
     def __init__(self):
@@ -109,6 +149,7 @@ class EmbeddingNetwork(nn.Module):
         self.sequence_length = params.sequence_length
 
         self.vision_embedding = VisionNetwork()
+        self.vision_micro_batch_size = params.vision_micro_batch_size
         self.proprioception_embedding = torch.nn.Linear(self.proprioception_dim, self.d_model)
         self.action_embedding = torch.nn.Linear(self.action_dim, self.d_model)
         self.position_embedding = nn.Embedding(self.sequence_length, self.d_model)
@@ -119,6 +160,9 @@ class EmbeddingNetwork(nn.Module):
     def vision_embed(self, x):
         return self.vision_embedding(x)
 
+    def vision_embed_sequence(self, x):
+        return self.vision_embedding.forward_sequence(x, self.vision_micro_batch_size)
+
     def proprioception_embed(self, x):
         return self.proprioception_embedding(x)
 
@@ -213,7 +257,7 @@ class PlanProposal(nn.Module):
 
     def forward(self, vision_embedded, proprioception_embedded, goal_embedded):
 
-        x = torch.cat([vision_embedded, proprioception_embedded, goal_embedded], dim=1)  # (bs, 3*d_model)
+        x = torch.cat([vision_embedded, proprioception_embedded, goal_embedded], dim=-1)  # (bs, 3*d_model) or (bs, seq_len, 3*d_model)
         x = self.fc(x)
         mu = self.fc_mu(x)
         sigma = F.softplus(self.fc_sigma(x)+self.epsilon)
@@ -312,9 +356,39 @@ class Actor(nn.Module):
         # print('second lstm', x)
         x = x[:, -1, :]    # Take the last element of the sequence
 
-        weightings = self.alpha(x).view(-1, self.action_dim, self.num_distribs)
-        mu = self.mu(x).view(-1, self.action_dim, self.num_distribs)
-        scale = nn.functional.softplus(self.sigma(x)+self.epsilon).view(-1, self.action_dim, self.num_distribs)
+        return self.action_distribution(x)
+
+    def forward_sequence(self, vision_embedded, proprioception_embedded, latent, goal_embedded):
+        """
+        Action distributions for every timestep of a sequence, as get_action_step returns them one
+        step at a time from the start of the sequence.
+        The LSTMs run once over (vision_1, pro_1, vision_2, pro_2, ...), and (latent_t, goal) branch off
+        the states after pro_t for all timesteps at once, without being fed to later steps.
+        latent: (bs, seq_len, latent_dim), goal_embedded: (bs, d_model)
+        """
+        batch_size, sequence_length = vision_embedded.shape[:2]
+        x = torch.stack((vision_embedded, proprioception_embedded), dim=2
+        ).reshape(batch_size, 2*sequence_length, self.d_model)     # (bs, 2*seq_len, d_model)
+
+        h1, _ = self.lstm1(x)
+        h2, _ = self.lstm2(h1)
+        # states after each pro token, every timestep becomes one sequence of the branch batch
+        state1 = [s[:, 1::2, :].reshape(1, batch_size*sequence_length, -1) for s in (h1, cell_states(self.lstm1, x, h1))]
+        state2 = [s[:, 1::2, :].reshape(1, batch_size*sequence_length, -1) for s in (h2, cell_states(self.lstm2, h1, h2))]
+
+        goal_embedded = goal_embedded.unsqueeze(1).expand(batch_size, sequence_length, self.d_model)
+        x = torch.stack((latent, goal_embedded), dim=2
+        ).reshape(batch_size*sequence_length, 2, self.d_model)     # (bs*seq_len, 2, d_model)
+        x, _ = self.lstm1(x, state1)
+        x, _ = self.lstm2(x, state2)
+        x = x[:, -1, :].reshape(batch_size, sequence_length, -1)    # (bs, seq_len, layer_size)
+
+        return self.action_distribution(x)
+
+    def action_distribution(self, x):
+        weightings = self.alpha(x).view(*x.shape[:-1], self.action_dim, self.num_distribs)
+        mu = self.mu(x).view(*x.shape[:-1], self.action_dim, self.num_distribs)
+        scale = nn.functional.softplus(self.sigma(x)+self.epsilon).view(*x.shape[:-1], self.action_dim, self.num_distribs)
         logistic_mixture = LogisticMixture(weightings, mu, scale)
 
         return logistic_mixture
@@ -341,6 +415,66 @@ class Actor(nn.Module):
 
         return action, action_log_prob
 
+    def init_state(self, batch_size):
+        """
+        Empty state for get_action_step: the LSTM states, and the last sequence_length (vision, pro)
+        steps for re-seeding them after eviction.
+        """
+        return dict(
+            lstm1=None,
+            lstm2=None,
+            steps=torch.zeros((batch_size, self.sequence_length, 2, self.d_model), device=self.device),
+            length=0,
+        )
+
+    def get_action_step(self, vision_embedded, proprioception_embedded, latent, goal_embedded, state=None):
+        """
+        Streaming counterpart of get_action for closed-loop control.
+        Only the newest (vision, pro) pair is fed, on top of the LSTM states carried from the previous
+        step, so the cost per step does not grow with the context. Latent and goal branch off the
+        updated states without being added to them, as at the end of the sequence in forward.
+        The context is capped at sequence_length steps like the window of get_action: once it is full
+        the states are re-seeded from the newest half, so they never cover the whole episode.
+        vision_embedded, proprioception_embedded, latent, goal_embedded: (bs, d_model)
+        state: state returned by the previous call, None at the start of an episode
+        """
+        if state is None:
+            state = self.init_state(vision_embedded.shape[0])
+        if state['length'] == self.sequence_length:
+            self._evict(state)
+
+        step = state['length']
+        x = torch.stack((vision_embedded, proprioception_embedded), dim=1)  # (bs, 2, d_model)
+        state['steps'][:, step] = x
+        x, state['lstm1'] = self.lstm1(x, state['lstm1'])
+        _, state['lstm2'] = self.lstm2(x, state['lstm2'])
+        state['length'] = step + 1
+
+        x = torch.stack((latent, goal_embedded), dim=1)  # (bs, 2, d_model)
+        x, _ = self.lstm1(x, state['lstm1'])
+        x, _ = self.lstm2(x, state['lstm2'])
+
+        logistic_mixture = self.action_distribution(x[:, -1, :])
+        action = logistic_mixture.sample()
+        action_log_prob = logistic_mixture.log_prob(action)
+
+        return action, action_log_prob, state
+
+    def _evict(self, state):
+        """
+        Drop the oldest half of the steps and re-run the LSTMs over the others from zero states.
+        """
+        keep = self.sequence_length // 2
+        state['length'] = keep
+        state['lstm1'], state['lstm2'] = None, None
+        if keep == 0:
+            return
+        steps = state['steps'][:, self.sequence_length - keep:].clone()
+        state['steps'][:, :keep] = steps
+        x = steps.reshape(steps.shape[0], 2*keep, self.d_model)
+        x, state['lstm1'] = self.lstm1(x)
+        _, state['lstm2'] = self.lstm2(x)
+
 
 class Critic(nn.Module):
     def __init__(self, layer_size=1024):
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# the modules import each other as top-level siblings, e.g. `import parameters as params`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parameters as params
+
+
+@pytest.fixture
+def small_params(monkeypatch):
+    """Shrink the global parameters so models and buffers are cheap to build."""
+    for name, value in dict(
+        vision_dim=(4, 64, 64),
+        proprioception_dim=7,
+        action_dim=8,
+        latent_dim=32,
+        d_model=32,
+        n_heads=4,
+        sequence_length=5,
+        memory_size=16,
+        batch_size=4,
+        device=params.torch.device("cpu"),
+    ).items():
+        monkeypatch.setattr(params, name, value)
+    return params
@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+import rnn_model
+import transformer_model
+
+
+def make_actor(model):
+    actor = model.Actor().eval()
+    # the transformer initialization zeroes every 1-D parameter, layer norm gains included, which
+    # would make its output independent of the inputs
+    for module in actor.modules():
+        if isinstance(module, torch.nn.LayerNorm):
+            torch.nn.init.normal_(module.weight, 1.0, 0.1)
+            torch.nn.init.normal_(module.bias, 0.0, 0.1)
+    return actor
+
+
+def step_log_probs(actor, vision, proprioception, latent, goal):
+    """Actions and log probabilities of get_action_step, fed one timestep at a time."""
+    actions, log_probs, state = [], [], None
+    for t in range(vision.shape[1]):
+        action, log_prob, state = actor.get_action_step(vision[:, t], proprioception[:, t], latent[:, t], goal, state)
+        actions.append(action)
+        log_probs.append(log_prob)
+    return torch.stack(actions, dim=1), torch.stack(log_probs, dim=1)
+
+
+@pytest.mark.parametrize("model", [rnn_model, transformer_model])
+def test_forward_sequence_matches_get_action_step(small_params, model):
+    torch.manual_seed(0)
+    actor = make_actor(model)
+    batch_size, sequence_length, d_model = 3, small_params.sequence_length, small_params.d_model
+    vision = torch.randn(batch_size, sequence_length, d_model)
+    proprioception = torch.randn(batch_size, sequence_length, d_model)
+    latent = torch.randn(batch_size, sequence_length, d_model)
+    goal = torch.randn(batch_size, d_model)
+
+    with torch.no_grad():
+        actions, log_probs = step_log_probs(actor, vision, proprioception, latent, goal)
+        distribution = actor.forward_sequence(vision, proprioception, latent, goal)
+
+    torch.testing.assert_close(distribution.log_prob(actions), log_probs, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("model", [rnn_model, transformer_model])
+def test_forward_sequence_is_causal(small_params, model):
+    torch.manual_seed(0)
+    actor = make_actor(model)
+    batch_size, sequence_length, d_model = 2, small_params.sequence_length, small_params.d_model
+    inputs = [torch.randn(batch_size, sequence_length, d_model) for _ in range(3)]
+    goal = torch.randn(batch_size, d_model)
+    action = torch.rand(batch_size, sequence_length, small_params.action_dim) * 2 - 1
+
+    with torch.no_grad():
+        log_prob = actor.forward_sequence(*inputs, goal).log_prob(action)
+        # changing the last step leaves the earlier ones untouched
+        for x in inputs:
+            x[:, -1] += 1
+        changed = actor.forward_sequence(*inputs, goal).log_prob(action)
+
+    torch.testing.assert_close(changed[:, :-1], log_prob[:, :-1])
+    assert not torch.allclose(changed[:, -1], log_prob[:, -1])
+
+
+@pytest.mark.parametrize("model", [rnn_model, transformer_model])
+def test_get_action_step_caps_context(small_params, model):
+    torch.manual_seed(0)
+    actor = make_actor(model)
+    batch_size, sequence_length, d_model = 2, small_params.sequence_length, small_params.d_model
+    vision, proprioception, latent = [torch.randn(batch_size, sequence_length + 1, d_model) for _ in range(3)]
+    goal = torch.randn(batch_size, d_model)
+
+    with torch.no_grad():
+        actions, log_probs = step_log_probs(actor, vision, proprioception, latent, goal)
+        # past sequence_length steps only the newest half of the window is kept
+        start = sequence_length - sequence_length // 2
+        distribution = actor.forward_sequence(vision[:, start:], proprioception[:, start:], latent[:, start:], goal)
+
+    torch.testing.assert_close(distribution.log_prob(actions[:, -1:])[:, -1], log_probs[:, -1], rtol=1e-4, atol=1e-4)
@@ -0,0 +1,36 @@
+import torch
+
+from context_buffer import ContextBuffer
+
+
+def windows(entries, capacity):
+    return [torch.stack(entries[max(0, i - capacity + 1):i + 1], dim=1) for i in range(len(entries))]
+
+
+def test_view_is_the_sliding_window():
+    torch.manual_seed(0)
+    entries = [torch.randn(2, 3) for _ in range(7)]
+    buffer = ContextBuffer(2, 4, 3, torch.device("cpu"))
+    with torch.no_grad():
+        for entry, window in zip(entries, windows(entries, 4)):
+            buffer.append(entry)
+            assert len(buffer) == window.shape[1]
+            torch.testing.assert_close(buffer.view(), window)
+
+    buffer.reset()
+    assert len(buffer) == 0 and buffer.view().shape == (2, 0, 3)
+
+
+def test_gradients_flow_through_earlier_entries():
+    torch.manual_seed(0)
+    inputs = [torch.randn(2, 3, requires_grad=True) for _ in range(7)]
+    buffer = ContextBuffer(2, 4, 3, torch.device("cpu"))
+    loss = 0
+    for x in inputs:
+        buffer.append(2 * x)
+        loss = loss + (buffer.view() ** 2).sum()
+    loss.backward()
+
+    expected_loss = sum((window ** 2).sum() for window in windows([2 * x for x in inputs], 4))
+    for x, expected in zip(inputs, torch.autograd.grad(expected_loss, inputs)):
+        torch.testing.assert_close(x.grad, expected)
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from prioritized_replay_buffer import PrioritizedReplayBuffer
+
+
+def make_trajectory(params, length, seed=0):
+    """Random trajectory in the layout store_many takes, frames scaled like preprocessed RGBD."""
+    rng = np.random.default_rng(seed)
+    return dict(
+        vision=rng.uniform(size=(length + 1, *params.vision_dim)).astype(np.float32),
+        proprioception=rng.normal(size=(length + 1, params.proprioception_dim)).astype(np.float32),
+        action=rng.uniform(-1, 1, size=(length, params.action_dim)).astype(np.float32),
+        reward=rng.normal(size=length).astype(np.float32),
+        done=np.eye(length, dtype=np.float32)[-1],
+    )
+
+
+def store_steps(buffer, trajectory):
+    """Store a trajectory one transition at a time."""
+    vision, proprioception = trajectory["vision"], trajectory["proprioception"]
+    for t in range(len(trajectory["action"])):
+        buffer.store(vision[t], proprioception[t], trajectory["action"][t], trajectory["reward"][t],
+                     vision[t + 1], proprioception[t + 1], trajectory["done"][t])
+
+
+def full_buffer(params, **kwargs):
+    buffer = PrioritizedReplayBuffer(**kwargs)
+    buffer.store_many(**make_trajectory(params, params.memory_size * params.sequence_length))
+    assert len(buffer) == params.memory_size
+    return buffer
+
+
+def test_weights_match_reference(small_params):
+    np.random.seed(0)
+    buffer = full_buffer(small_params, alpha=0.6, beta=0.4)
+    priorities = np.random.uniform(0.1, 3.0, size=len(buffer))
+    buffer.update_priorities(np.arange(len(buffer)), priorities)
+
+    batch = buffer.sample_batch()
+    p = priorities ** 0.6 / np.sum(priorities ** 0.6)
+    max_weight = (p.min() * len(buffer)) ** -0.4
+    expected = (p[batch["indices"]] * len(buffer)) ** -0.4 / max_weight
+    assert batch["weights"].dtype == np.float32
+    np.testing.assert_allclose(batch["weights"], expected, rtol=1e-5)
+
+
+def test_update_priorities_matches_one_at_a_time(small_params):
+    batched, single = full_buffer(small_params), full_buffer(small_params)
+    rng = np.random.default_rng(0)
+    # repeated indices, as a batch may sample the same slot twice
+    indices = rng.integers(len(batched), size=12)
+    priorities = rng.uniform(0.1, 5.0, size=12)
+
+    batched.update_priorities(indices, priorities)
+    for index, priority in zip(indices, priorities):
+        single.update_priorities([index], [priority])
+
+    np.testing.assert_allclose(batched.sum_tree.tree, single.sum_tree.tree)
+    np.testing.assert_array_equal(batched.min_tree.tree, single.min_tree.tree)
+    assert batched.max_priority == single.max_priority == priorities.max()
+
+
+def test_memmap_buffer_resumes(small_params, tmp_path):
+    names = ["vision_buf", "proprioception_buf", "action_buf", "reward_buf", "done_buf"]
+    buffer = PrioritizedReplayBuffer(memmap_dir=str(tmp_path))
+    # two full sequences and a short one ended by done
+    store_steps(buffer, make_trajectory(small_params, 2 * small_params.sequence_length + 2))
+    buffer.update_priorities([1], [4.0])
+    buffer.flush()
+    stored = {name: np.array(getattr(buffer, name)[:3]) for name in names}
+    trees = buffer.sum_tree.tree.copy(), buffer.min_tree.tree.copy()
+    del buffer
+
+    resumed = PrioritizedReplayBuffer(memmap_dir=str(tmp_path))
+    assert (resumed.ptr, resumed.size, resumed.sequence_counter, resumed.max_priority) == (3, 3, 0, 4.0)
+    for name in names:
+        np.testing.assert_array_equal(getattr(resumed, name)[:3], stored[name])
+    np.testing.assert_array_equal(resumed.sum_tree.tree, trees[0])
+    np.testing.assert_array_equal(resumed.min_tree.tree, trees[1])
+
+    # storing continues after the resumed slots
+    resumed.store_many(**make_trajectory(small_params, small_params.sequence_length, seed=1))
+    assert (resumed.ptr, resumed.size) == (4, 4)
+    np.testing.assert_array_equal(resumed.action_buf[:3], stored["action_buf"])
+
+    with pytest.raises(ValueError):
+        PrioritizedReplayBuffer(memmap_dir=str(tmp_path), capacity=small_params.memory_size + 1)
+    # embeddings kept on disk without their frames could not be recomputed for a new encoder
+    with pytest.raises(ValueError):
+        PrioritizedReplayBuffer(memmap_dir=str(tmp_path / "embeddings"), embedding_dim=8, store_vision=False)
+
+
+@pytest.mark.parametrize("compact_vision", [False, True])
+def test_store_many_matches_store(small_params, compact_vision):
+    # the last sequence is cut short by the end of the trajectory
+    trajectory = make_trajectory(small_params, 2 * small_params.sequence_length + 2)
+    batched, single = PrioritizedReplayBuffer(compact_vision=compact_vision), PrioritizedReplayBuffer(compact_vision=compact_vision)
+    np.testing.assert_array_equal(batched.store_many(**trajectory), [0, 1, 2])
+    store_steps(single, trajectory)
+
+    assert (batched.ptr, batched.size) == (single.ptr, single.size) == (3, 3)
+    vision = ["vision_rgb_buf", "vision_depth_buf"] if compact_vision else ["vision_buf"]
+    for name in vision + ["proprioception_buf", "action_buf", "reward_buf", "done_buf"]:
+        np.testing.assert_array_equal(getattr(batched, name), getattr(single, name), err_msg=name)
+    np.testing.assert_array_equal(batched.sum_tree.tree, single.sum_tree.tree)
+    np.testing.assert_array_equal(batched.min_tree.tree, single.min_tree.tree)
+
+
+
+def test_gather_rejects_out_of_range_indices(small_params):
+    buffer = full_buffer(small_params)
+    with pytest.raises(AssertionError):
+        buffer._gather(np.array([0, 1, 2, small_params.memory_size]), buffer.allocate_batch())
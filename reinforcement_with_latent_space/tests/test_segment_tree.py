@@ -0,0 +1,58 @@
+import numpy as np
+
+from segment_tree import MinSegmentTree, SumSegmentTree
+
+
+def filled_trees(values, batch):
+    sum_tree, min_tree = SumSegmentTree(len(values)), MinSegmentTree(len(values))
+    if batch:
+        indices = np.arange(len(values))
+        sum_tree[indices] = values
+        min_tree[indices] = values
+    else:
+        for i, value in enumerate(values):
+            sum_tree[i] = value
+            min_tree[i] = value
+    return sum_tree, min_tree
+
+
+def test_batch_setitem_matches_scalar():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(0.1, 2.0, size=16)
+    batch_sum, batch_min = filled_trees(values, batch=True)
+    sum_tree, min_tree = filled_trees(values, batch=False)
+    np.testing.assert_allclose(batch_sum.tree, sum_tree.tree)
+    np.testing.assert_array_equal(batch_min.tree, min_tree.tree)
+
+    # repeated and unordered indices, the last write wins
+    indices = np.array([5, 3, 5, 12])
+    batch_sum[indices] = [1.0, 2.0, 3.0, 4.0]
+    for i, value in zip(indices, [1.0, 2.0, 3.0, 4.0]):
+        sum_tree[int(i)] = value
+    np.testing.assert_allclose(batch_sum.tree, sum_tree.tree)
+    np.testing.assert_allclose(batch_sum[indices], [3.0, 2.0, 3.0, 4.0])
+
+
+def test_sum_and_min_over_ranges():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(0.1, 2.0, size=16)
+    sum_tree, min_tree = filled_trees(values, batch=True)
+    # the end index is exclusive, 0 means the whole tree
+    for start, end in [(0, 15), (0, 0), (3, 9), (7, 8), (15, 16)]:
+        np.testing.assert_allclose(sum_tree.sum(start, end), values[start:end].sum() if end > start else values.sum())
+        expected_min = values[start:end].min() if end > start else values.min()
+        assert min_tree.min(start, end) == expected_min
+
+
+def test_batch_retrieve_matches_scalar():
+    rng = np.random.default_rng(2)
+    values = rng.uniform(0.0, 2.0, size=16)
+    values[[4, 10]] = 0.0  # empty leaves are never retrieved
+    sum_tree, _ = filled_trees(values, batch=True)
+    upperbounds = np.append(rng.uniform(0, sum_tree.sum(), size=64), 0.0)
+
+    indices = sum_tree.retrieve(upperbounds)
+    np.testing.assert_array_equal(indices, [sum_tree.retrieve(float(u)) for u in upperbounds])
+    # the retrieved leaf is the one whose cumulative range holds the upper bound
+    np.testing.assert_array_equal(indices, np.searchsorted(np.cumsum(values), upperbounds, side="right"))
+    assert not np.isin(indices, [4, 10]).any()
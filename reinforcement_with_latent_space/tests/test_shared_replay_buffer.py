@@ -0,0 +1,109 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from prioritized_replay_buffer import SharedPrioritizedReplayBuffer
+from test_replay_buffer import make_trajectory, store_steps
+
+
+def store_trajectory(buffer, trajectory, one_step_at_a_time):
+    """Child process body: fill slots of the shared buffer and detach."""
+    if one_step_at_a_time:
+        store_steps(buffer, trajectory)
+    else:
+        buffer.store_many(**trajectory)
+    buffer.close()
+
+
+def store_in_two_parts(buffer, trajectory, claimed, resume):
+    """Child process body: claim a slot, wait for `resume`, then finish the sequence."""
+    store_steps(buffer, {key: value[:2] if key in ("action", "reward", "done") else value[:3]
+                         for key, value in trajectory.items()})
+    claimed.set()
+    resume.wait(timeout=120)
+    store_steps(buffer, {key: value[2:] for key, value in trajectory.items()})
+    buffer.close()
+
+
+def join(process):
+    process.join(timeout=120)
+    assert process.exitcode == 0
+
+
+def run_child(*args):
+    process = multiprocessing.Process(target=store_trajectory, args=args)
+    process.start()
+    join(process)
+
+
+@pytest.fixture(params=["fork", "spawn"])
+def start_method(request):
+    """Run the test with each start method; the buffer's lock must come from the same one."""
+    if request.param not in multiprocessing.get_all_start_methods():
+        pytest.skip("{} is not available".format(request.param))
+    previous = multiprocessing.get_start_method()
+    multiprocessing.set_start_method(request.param, force=True)
+    yield request.param
+    multiprocessing.set_start_method(previous, force=True)
+
+
+def test_children_store_and_parent_samples(small_params, start_method):
+    buffer = SharedPrioritizedReplayBuffer()
+    try:
+        sequence_length = small_params.sequence_length
+        many = make_trajectory(small_params, 3 * sequence_length, seed=0)
+        steps = make_trajectory(small_params, sequence_length - 2, seed=1)
+        run_child(buffer, many, False)
+        run_child(buffer, steps, True)
+
+        # the position and the slots written by the children are visible here
+        assert (buffer.ptr, buffer.size, len(buffer)) == (4, 4, 4)
+        assert not buffer.claimed_buf.any()
+        np.testing.assert_array_equal(buffer.action_buf[:3].reshape(-1, small_params.action_dim), many["action"])
+        np.testing.assert_array_equal(buffer.vision_buf[3, :sequence_length - 1], steps["vision"])
+        np.testing.assert_array_equal(buffer.action_buf[3, :sequence_length - 2], steps["action"])
+        np.testing.assert_array_equal(buffer.sum_tree[np.arange(4)], 1.0)
+
+        batch = buffer.sample_batch()
+        assert np.all(batch["indices"] < 4)
+        np.testing.assert_array_equal(batch["action"], buffer.action_buf[batch["indices"]])
+        np.testing.assert_allclose(batch["weights"], 1.0)
+
+        buffer.update_priorities(batch["indices"][:1], [2.0])
+        assert buffer.max_priority == 2.0
+        # the next slot a child stores gets the updated max priority
+        run_child(buffer, make_trajectory(small_params, sequence_length, seed=2), False)
+        assert buffer.sum_tree[4] == 2.0 ** buffer.alpha
+    finally:
+        buffer.unlink()
+
+
+def test_slots_published_out_of_order(small_params, start_method):
+    buffer = SharedPrioritizedReplayBuffer()
+    try:
+        sequence_length = small_params.sequence_length
+        slow = make_trajectory(small_params, sequence_length, seed=0)
+        claimed, resume = multiprocessing.Event(), multiprocessing.Event()
+        process = multiprocessing.Process(target=store_in_two_parts, args=(buffer, slow, claimed, resume))
+        process.start()
+        assert claimed.wait(timeout=120)
+
+        # slot 0 is still being written when the next slots are published
+        fast = make_trajectory(small_params, 4 * sequence_length, seed=1)
+        run_child(buffer, fast, False)
+        assert (buffer.ptr, buffer.size) == (5, 4)
+        assert buffer.claimed_buf[0] and not buffer.claimed_buf[1:5].any()
+        # equal priorities and one draw per segment of the total, so every published slot is drawn
+        batch = buffer.sample_batch()
+        np.testing.assert_array_equal(np.sort(batch["indices"]), np.arange(1, 5))
+        np.testing.assert_array_equal(batch["action"], buffer.action_buf[batch["indices"]])
+        buffer.update_priorities(batch["indices"], np.full(len(batch["indices"]), 2.0))
+
+        resume.set()
+        join(process)
+        assert (buffer.size, buffer.sum_tree[0]) == (5, 2.0 ** buffer.alpha)
+        np.testing.assert_array_equal(buffer.action_buf[0], slow["action"])
+    finally:
+        resume.set()
+        buffer.unlink()
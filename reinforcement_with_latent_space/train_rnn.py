@@ -4,8 +4,9 @@ from torch.nn.utils import clip_grad_norm_
 
 from rnn_model import EmbeddingNetwork, PlanRecognition, PlanProposal, Actor, Critic
 from rl import PPO, TargetRL
+from context_buffer import ContextBuffer
 from noise import OrnsteinUhlenbeckProcess
-from utils import compute_regularisation_loss
+from utils import compute_regularisation_loss, compute_sequence_regularisation_loss
 import parameters as params
   
 class AgentTrainer():
@@ -39,13 +40,18 @@ class AgentTrainer():
     self.mse_loss = torch.nn.MSELoss()
     self.tau = params.tau
     self.beta = params.beta
+    self.parallel_pretrain = params.parallel_pretrain
+    self.stateful_actor = params.stateful_actor
+    # the parallel loss trains the input layout of get_action_step, the sequential one that of get_action
+    assert self.parallel_pretrain == self.stateful_actor, "parallel_pretrain and stateful_actor must be set together"
+    self.actor_state = None
     self.sequence_length = params.sequence_length
     self.d_model = params.d_model
 
-    # Initialize buffers as tensors
-    self.vision_buffer = torch.empty((1, self.sequence_length, self.d_model)).to(self.device)
-    self.pproprioception_buffer = torch.empty((1, self.sequence_length, self.d_model)).to(self.device)
-    self.action_buffer = torch.empty(1, self.sequence_length, self.d_model).to(self.device)
+    # Initialize buffers as device-side ring buffers
+    self.vision_buffer = ContextBuffer(1, self.sequence_length, self.d_model, self.device)
+    self.pproprioception_buffer = ContextBuffer(1, self.sequence_length, self.d_model, self.device)
+    self.action_buffer = ContextBuffer(1, self.sequence_length, self.d_model, self.device)
 
     """ Wrap your models with DataParallel """
     if torch.cuda.device_count() > 1:
@@ -86,13 +92,17 @@ class AgentTrainer():
 
   def set_goal(self, goal):
     self.embedding.eval()
-    goal = torch.FloatTensor(goal).to(self.device)
+    goal = torch.as_tensor(goal, dtype=torch.float32, device=self.device)
     self.goal = goal.unsqueeze(0)
     # self.goal_embedded = self.embedding.vision_embed(goal)
+    self.clear_buffer()
 
-  def update_buffer(self, buffer, new_data):
-
-      return torch.cat((buffer[:, 1:, :], new_data.unsqueeze(1) ), dim=1)
+  def clear_buffer(self):
+    """ A new goal starts a new episode, so the context is emptied """
+    self.vision_buffer.reset()
+    self.pproprioception_buffer.reset()
+    self.action_buffer.reset()
+    self.actor_state = None
 
   def get_action(self, vision, proprioception, greedy=True):
 
@@ -102,22 +112,25 @@ class AgentTrainer():
     self.actor.eval()
     
     with torch.no_grad():
-      proprioception = torch.FloatTensor(proprioception).to(self.device)
-      vision = torch.FloatTensor(vision).to(self.device)
+      proprioception = torch.as_tensor(proprioception, dtype=torch.float32, device=self.device)
+      vision = torch.as_tensor(vision, dtype=torch.float32, device=self.device)
 
       vision_embedded = self.embedding.vision_embed(vision)
       proprioception_embedded = self.embedding.proprioception_embed(proprioception)
       goal_embedded = self.embedding.vision_embed(self.goal)
 
-      self.vision_buffer = self.update_buffer(self.vision_buffer, vision_embedded)
-      self.pproprioception_buffer = self.update_buffer(self.pproprioception_buffer, proprioception_embedded)
-
       latent = self.plan_proposal(vision_embedded, proprioception_embedded, goal_embedded).sample()
 
-      action, _ = self.actor.get_action(self.vision_buffer, self.pproprioception_buffer, latent, goal_embedded, self.action_buffer)
+      if self.stateful_actor:
+        action, _, self.actor_state = self.actor.get_action_step(vision_embedded, proprioception_embedded, latent, goal_embedded, self.actor_state)
+      else:
+        self.vision_buffer.append(vision_embedded)
+        self.pproprioception_buffer.append(proprioception_embedded)
 
-      action_embedded= self.embedding.action_embed(action)
-      self.action_buffer = self.update_buffer(self.action_buffer, action_embedded)
+        action, _ = self.actor.get_action(self.vision_buffer.view(), self.pproprioception_buffer.view(), latent, goal_embedded, self.action_buffer.view())
+
+        action_embedded= self.embedding.action_embed(action)
+        self.action_buffer.append(action_embedded)
       
       action = action.detach().cpu().numpy()
       if not greedy:
@@ -125,19 +138,24 @@ class AgentTrainer():
 
       return action[0]
 
-  def pre_train(self, action_labels, video, proprioception):
+  def pre_train(self, action_labels, video, proprioception, mask=None):
 
+    # the encoder is about to change, so embeddings cached for fine-tuning go stale
+    self.target_rl.unfreeze_encoder()
     self.embedding.train()
     self.plan_recognition.train()
     self.plan_proposal.train()
     self.actor.train()
 
     action_labels = action_labels.to(self.device)
-    video = torch.FloatTensor(video).to(self.device)
-    proprioception = torch.FloatTensor(proprioception).to(self.device)
+    # cast after the transfer, preprocessed demonstrations arrive as float16
+    video = torch.as_tensor(video).to(self.device).float()
+    proprioception = torch.as_tensor(proprioception).to(self.device).float()
+    # windowed batches are left-padded, padded steps have mask 0 and are left out of every loss
+    mask = torch.ones(video.shape[:2], device=self.device) if mask is None else torch.as_tensor(mask).to(self.device).float()
 
     sequence_length = video.shape[1]
-    video_embedded = torch.stack([self.embedding.vision_embed(video[:, i, :, :, :]) for i in range(sequence_length)], dim=1)
+    video_embedded = self.embedding.vision_embed_sequence(video)
     proprioception_embedded = self.embedding.proprioception_embed(proprioception)
     goal_embedded = video_embedded[:, -1, :]
 
@@ -145,23 +163,38 @@ class AgentTrainer():
     recognition_dist = self.plan_recognition(video_embedded, proprioception_embedded)
     
     """ Compute the loss for batches sequence of data """
-    action_buffer = torch.empty((self.batch_size, self.sequence_length, self.d_model)).to(self.device)
-    kl_loss, normal_kl_loss, recon_loss = 0, 0, 0
-    for i in range(sequence_length):
-      proposal_dist = self.plan_proposal(video_embedded[:, i, :], proprioception_embedded[:, i, :], goal_embedded)
+    action_buffer = ContextBuffer(self.batch_size, self.sequence_length, self.d_model, self.device)
+    if self.parallel_pretrain:
+      """ Teacher-forced: proposals and action distributions for every timestep at once """
+      goal_sequence = goal_embedded.unsqueeze(1).expand_as(video_embedded)
+      proposal_dist = self.plan_proposal(video_embedded, proprioception_embedded, goal_sequence)
 
-      kl_loss += compute_regularisation_loss(recognition_dist, proposal_dist)
-      
-      normal_kl_loss += torch.mean(-0.5 * torch.sum(1 + proposal_dist.scale**2 - 
-                                                 proposal_dist.loc**2 - torch.exp(proposal_dist.scale**2), dim=1), dim=0)
+      kl_loss = compute_sequence_regularisation_loss(recognition_dist, proposal_dist, mask)
+      normal_kl_loss = torch.mean(-0.5 * torch.sum(1 + proposal_dist.scale**2 - 
+                                                 proposal_dist.loc**2 - torch.exp(proposal_dist.scale**2), dim=-1) * mask, dim=0).sum()
 
       proposal_latent = proposal_dist.sample()
-      """ Prepend the goal to let the network attend to it """   
-      pred_action, _ = self.actor.get_action(video_embedded[:, :i, :], proprioception_embedded[:, :i, :], proposal_latent, goal_embedded, self.action_buffer)
-      action_embedded= self.embedding.action_embed(pred_action)
-      action_buffer = self.update_buffer(action_buffer, action_embedded)
+      action_dist = self.actor.forward_sequence(video_embedded, proprioception_embedded, proposal_latent, goal_embedded)
+      # sampled actions carry no gradient, so fit the distribution by its per-step negative log-likelihood,
+      # averaged over the batch and summed over time
+      recon_loss = -torch.mean(action_dist.log_prob(action_labels).sum(dim=-1) * mask, dim=0).sum()
+    else:
+      kl_loss, normal_kl_loss, recon_loss = 0, 0, 0
+      for i in range(sequence_length):
+        proposal_dist = self.plan_proposal(video_embedded[:, i, :], proprioception_embedded[:, i, :], goal_embedded)
+
+        kl_loss += compute_regularisation_loss(recognition_dist, proposal_dist, mask[:, i])
+      
+        normal_kl_loss += torch.mean(-0.5 * torch.sum(1 + proposal_dist.scale**2 - 
+                                                   proposal_dist.loc**2 - torch.exp(proposal_dist.scale**2), dim=1) * mask[:, i], dim=0)
+
+        proposal_latent = proposal_dist.sample()
+        """ Prepend the goal to let the network attend to it """   
+        pred_action, _ = self.actor.get_action(video_embedded[:, :i, :], proprioception_embedded[:, :i, :], proposal_latent, goal_embedded, action_buffer.view())
+        action_embedded= self.embedding.action_embed(pred_action)
+        action_buffer.append(action_embedded)
 
-      recon_loss += self.mse_loss(action_labels[:, i, :], pred_action)
+        recon_loss += torch.mean(torch.mean((action_labels[:, i, :] - pred_action)**2, dim=-1) * mask[:, i])
 
     # Compute the batch loss
     loss = self.beta*(kl_loss + normal_kl_loss) + recon_loss / sequence_length
@@ -190,6 +223,7 @@ class AgentTrainer():
   
   def fine_tune(self):
 
+    self.target_rl.freeze_encoder()
     critic_loss, actor_loss = self.target_rl.update_model(self.goal)
     self.target_rl.update_target()
 
@@ -212,12 +246,15 @@ class AgentTrainer():
     
     # Use torch.save to serialize and save the checkpoint dictionary
     torch.save(checkpoint, filename)
+    # a memory-mapped replay buffer resumes from its own directory
+    self.target_rl.pri_buffer.flush()
     print('Model saved')
 
   def load_checkpoint(self, filename):
       checkpoint = torch.load(filename)
 
       self.embedding.load_state_dict(checkpoint['embedding_state_dict'])
+      self.target_rl.unfreeze_encoder()
       self.plan_recognition.load_state_dict(checkpoint['plan_recognition_state_dict'])
       self.plan_proposal.load_state_dict(checkpoint['plan_proposal_state_dict'])
 
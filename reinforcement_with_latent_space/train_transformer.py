@@ -3,7 +3,8 @@ import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
 from transformer_model import EmbeddingNetwork, PlanRecognition, PlanProposal, Actor, Critic
 from noise import OrnsteinUhlenbeckProcess
-from utils import compute_regularisation_loss
+from context_buffer import ContextBuffer
+from utils import compute_regularisation_loss, compute_sequence_regularisation_loss
 import parameters as params
   
 class AgentTrainer():
@@ -39,9 +40,14 @@ class AgentTrainer():
     self.mse_loss = torch.nn.MSELoss()
     self.tau = params.tau
     self.beta = params.beta
-
-    # Initialize buffers as tensors
-    self.action_buffer = torch.empty((1, self.sequence_length, params.d_model)).to(self.device)
+    self.parallel_pretrain = params.parallel_pretrain
+    self.stateful_actor = params.stateful_actor
+    # the parallel loss trains the input layout of get_action_step, the sequential one that of get_action
+    assert self.parallel_pretrain == self.stateful_actor, "parallel_pretrain and stateful_actor must be set together"
+    self.actor_cache = None
+
+    # Initialize buffers as device-side ring buffers
+    self.action_buffer = ContextBuffer(1, self.sequence_length, params.d_model, self.device)
     
     # self.train_latent_buffer = torch.empty(
     #     (self.batch_size, self.sequence_length, params.latent_dim)).to(self.device)
@@ -70,51 +76,68 @@ class AgentTrainer():
       self.target_actor = self.target_actor.to(self.device)
       self.target_critic = self.target_critic.to(self.device)
 
-  def update_buffer(self, buffer, new_data):
-
-      return torch.cat((buffer[:, 1:, :], new_data.unsqueeze(1) ), dim=1)
-    
   def set_goal(self, goal):
-    goal = torch.FloatTensor(goal).to(self.device)
+    goal = torch.as_tensor(goal, dtype=torch.float32, device=self.device)
     goal = goal.unsqueeze(0)
     self.goal_embeded = self.embedding.vision_embed(goal)
+    # a new goal starts a new episode, so the context is emptied
+    self.action_buffer.reset()
+    self.actor_cache = None
   
-  def pre_train(self, action_labels, video, proprioception):
+  def pre_train(self, action_labels, video, proprioception, mask=None):
 
     action_labels = action_labels.to(self.device)
-    video = torch.FloatTensor(video).to(self.device)
-    proprioception = torch.FloatTensor(proprioception).to(self.device)
+    # cast after the transfer, preprocessed demonstrations arrive as float16
+    video = torch.as_tensor(video).to(self.device).float()
+    proprioception = torch.as_tensor(proprioception).to(self.device).float()
+    # windowed batches are left-padded, padded steps have mask 0 and are left out of every loss
+    mask = torch.ones(video.shape[:2], device=self.device) if mask is None else torch.as_tensor(mask).to(self.device).float()
 
     sequence_length = video.shape[1]
-    vision_embedded = torch.stack([self.embedding.vision_embed(video[:, i, :, :, :]) for i in range(sequence_length)], dim=1)
+    vision_embedded = self.embedding.vision_embed_sequence(video)
     proprioception_embedded = self.embedding.proprioception_embed(proprioception)
 
     goal_embedded = vision_embedded[:, -1, :]
 
-    action_buffer = torch.empty((self.batch_size, self.sequence_length, params.d_model)).to(self.device)
+    action_buffer = ContextBuffer(self.batch_size, self.sequence_length, params.d_model, self.device)
 
     """ Combine CNN output with proprioception data """
     recognition_dist = self.plan_recognition(vision_embedded, proprioception_embedded)
     
     """ Compute the loss for batches sequence of data """
-    kl_loss, normal_kl_loss, recon_loss = 0, 0, 0
-    for i in range(sequence_length):
-      proposal_dist = self.plan_proposal(vision_embedded[:, i, :], proprioception_embedded[:, i, :], goal_embedded)
+    if self.parallel_pretrain:
+      """ Teacher-forced: proposals and action distributions for every timestep at once """
+      goal_sequence = goal_embedded.unsqueeze(1).expand_as(vision_embedded)
+      proposal_dist = self.plan_proposal(vision_embedded, proprioception_embedded, goal_sequence)
+
+      kl_loss = compute_sequence_regularisation_loss(recognition_dist, proposal_dist, mask)
+      normal_kl_loss = torch.mean(-0.5 * torch.sum(1 + proposal_dist.scale**2 - 
+                                                 proposal_dist.loc**2 - torch.exp(proposal_dist.scale**2), dim=-1) * mask, dim=0).sum()
+
+      proposal_latent = proposal_dist.sample()
+      action_dist = self.actor.forward_sequence(vision_embedded, proprioception_embedded, proposal_latent, goal_embedded)
+      # sampled actions carry no gradient, so fit the distribution by its per-step negative log-likelihood,
+      # averaged over the batch and summed over time
+      recon_loss = -torch.mean(action_dist.log_prob(action_labels).sum(dim=-1) * mask, dim=0).sum()
+    else:
+      kl_loss, normal_kl_loss, recon_loss = 0, 0, 0
+      for i in range(sequence_length):
+        proposal_dist = self.plan_proposal(vision_embedded[:, i, :], proprioception_embedded[:, i, :], goal_embedded)
 
-      kl_loss += compute_regularisation_loss(recognition_dist, proposal_dist)
+        kl_loss += compute_regularisation_loss(recognition_dist, proposal_dist, mask[:, i])
       
-      normal_kl_loss += torch.mean(-0.5 * torch.sum(1 + proposal_dist.scale**2 - proposal_dist.loc**2 - torch.exp(proposal_dist.scale**2), dim=1), dim=0)
+        normal_kl_loss += torch.mean(-0.5 * torch.sum(1 + proposal_dist.scale**2 - proposal_dist.loc**2 - torch.exp(proposal_dist.scale**2), dim=1) * mask[:, i], dim=0)
 
-      latent = proposal_dist.sample()
-      """ Prepend the goal to let the network attend to it """
+        latent = proposal_dist.sample()
+        """ Prepend the goal to let the network attend to it """
       
-      action, _ = self.actor.get_action(vision_embedded[:, :i, :], proprioception_embedded[:, :i, :], latent, goal_embedded, action_buffer)
+        action, _ = self.actor.get_action(vision_embedded[:, :i, :], proprioception_embedded[:, :i, :], latent, goal_embedded, action_buffer.view())
 
-      action_embedded= self.embedding.action_embed(action)
+        action_embedded= self.embedding.action_embed(action)
     
-      action_buffer = self.update_buffer(action_buffer, action_embedded)
+        action_buffer.append(action_embedded)
 
-      recon_loss += self.mse_loss(action_labels[:, i, :], action)
+        recon_loss += torch.mean(torch.mean((action_labels[:, i, :] - action)**2, dim=-1) * mask[:, i])
 
     # Compute the batch loss
     loss = self.beta*(kl_loss + normal_kl_loss) + recon_loss / sequence_length
@@ -149,8 +172,8 @@ class AgentTrainer():
     self.actor.eval()
 
     with torch.no_grad():
-      proprioception = torch.FloatTensor(proprioception).unsqueeze(0).to(self.device)
-      vision = torch.FloatTensor(vision).unsqueeze(0).to(self.device)
+      proprioception = torch.as_tensor(proprioception, dtype=torch.float32, device=self.device).unsqueeze(0)
+      vision = torch.as_tensor(vision, dtype=torch.float32, device=self.device).unsqueeze(0)
       vision_embeded = self.embedding.vision_embed(vision)
       vision_embeded = vision_embeded.unsqueeze(0)
       proprioception_embedded = self.embedding.proprioception_embed(proprioception)
@@ -159,9 +182,13 @@ class AgentTrainer():
       proposal_dist = self.plan_proposal(vision_embeded[:, 0, :], proprioception_embedded[:, 0, :], self.goal_embeded)
       latent = proposal_dist.sample()
 
-      action = self.actor.get_action(vision_embeded, proprioception_embedded, latent, self.goal_embeded, self.action_buffer)
-      action_embedded= self.embedding.action_embed(action)
-      self.action_buffer = self.update_buffer(self.action_buffer, action_embedded)
+      if self.stateful_actor:
+        action, _, self.actor_cache = self.actor.get_action_step(vision_embeded[:, 0, :], proprioception_embedded[:, 0, :], latent,
+                                                                  self.goal_embeded, self.actor_cache)
+      else:
+        action = self.actor.get_action(vision_embeded, proprioception_embedded, latent, self.goal_embeded, self.action_buffer.view())
+        action_embedded= self.embedding.action_embed(action)
+        self.action_buffer.append(action_embedded)
 
       action = action.detach().cpu().numpy()
       if not greedy:
@@ -177,7 +204,7 @@ class AgentTrainer():
 
       next_action = self.target_actor.get_action(vision_embedded, proprioception_embedded, latent, self.goal_embeded)
       next_action_embedded= self.embedding.action_embed(next_action)
-      self.action_buffer = self.update_buffer(self.action_buffer, next_action_embedded)
+      self.action_buffer.append(next_action_embedded)
 
       if not greedy:
           next_action += torch.tensor(self.noise.sample(),dtype=torch.float).to(self.device)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.distributions import Normal
 from torch.distributions import Categorical, Distribution, AffineTransform, TransformedDistribution, SigmoidTransform
 from torch.distributions.mixture_same_family import MixtureSameFamily
@@ -55,29 +56,31 @@ class VisionNetwork(nn.Module):
                                     nn.ReLU(),
                                     nn.Linear(512, self.out_dim))
 
-    def _spatial_softmax(self, pre_softmax):
-        N, C, H, W = pre_softmax.shape
-        pre_softmax = pre_softmax.view(N*C, H * W)
-        softmax = F.softmax(pre_softmax, dim=1)
-        softmax = softmax.view(N, C, H, W)
+        # [H*W, 2] spatial softmax grid, other feature map sizes get theirs on first use
+        self.register_buffer("image_coords", self._image_coords(H, W), persistent=False)
+        self.extra_image_coords = {}
 
-        # Create normalized meshgrid
-        x_coords = torch.linspace(0, 1, W, device=self.device)
-        y_coords = torch.linspace(0, 1, H, device=self.device)
+    def _image_coords(self, H, W, device=None):
+        x_coords = torch.linspace(0, 1, W, device=device)
+        y_coords = torch.linspace(0, 1, H, device=device)
         X, Y = torch.meshgrid(x_coords, y_coords, indexing='xy')
-        image_coords = torch.stack([X, Y], dim=-1).to(self.device)  # [H, W, 2]
+        return torch.stack([X, Y], dim=-1).view(H * W, 2)
 
-        image_coords = image_coords.unsqueeze(0)  # [1, H, W, 2]
-        image_coords = image_coords.unsqueeze(0)  # [1, H, W, 2] -> [1, 1, H, W, 2]
+    def _spatial_softmax(self, pre_softmax):
+        N, C, H, W = pre_softmax.shape
+        softmax = F.softmax(pre_softmax.reshape(N, C, H * W), dim=-1)
 
-        # Reshape softmax for broadcasting
-        softmax = softmax.unsqueeze(-1)  # [N, C, H, W, 1]
+        image_coords = self.image_coords
+        if image_coords.shape[0] != H * W or image_coords.device != softmax.device:
+            key = (H, W, softmax.device)
+            if key not in self.extra_image_coords:
+                self.extra_image_coords[key] = self._image_coords(H, W, softmax.device)
+            image_coords = self.extra_image_coords[key]
 
         # Compute spatial soft argmax
         # This tensor represents the 'center of mass' for each channel of each feature map in the batch
-        spatial_soft_argmax = torch.sum(
-            softmax * image_coords, dim=[2, 3])  # [N, C, 2]
-        x = nn.Flatten()(spatial_soft_argmax)  # [N, C, 2] -> [N, 2*C]
+        spatial_soft_argmax = torch.matmul(softmax, image_coords.to(softmax.dtype))  # [N, C, 2]
+        x = spatial_soft_argmax.reshape(N, 2 * C)  # [N, C, 2] -> [N, 2*C]
         return x
 
     def forward(self, x):
@@ -86,6 +89,23 @@ class VisionNetwork(nn.Module):
         x = self.fc(spatial_soft_argmax)
         return x
 
+    def forward_sequence(self, x, micro_batch_size=None):
+        """
+        Encode a [B, T, C, H, W] sequence of frames into [B, T, out_dim].
+        Time is folded into the batch so every frame goes through one pass, or through passes of
+        `micro_batch_size` frames that are recomputed in backward to cap activation memory.
+        """
+        B, T = x.shape[:2]
+        frames = x.reshape(B * T, *x.shape[2:])
+        if micro_batch_size is None or micro_batch_size >= B * T:
+            out = self.forward(frames)
+        elif torch.is_grad_enabled():
+            out = torch.cat([checkpoint(self.forward, chunk, use_reentrant=False)
+                             for chunk in frames.split(micro_batch_size)], dim=0)
+        else:
+            out = torch.cat([self.forward(chunk) for chunk in frames.split(micro_batch_size)], dim=0)
+        return out.view(B, T, -1)
+
 
 class EmbeddingNetwork(nn.Module):
     def __init__(self):
@@ -96,6 +116,7 @@ class EmbeddingNetwork(nn.Module):
         self.sequence_length = params.sequence_length
 
         self.vision_embedding = VisionNetwork()
+        self.vision_micro_batch_size = params.vision_micro_batch_size
         self.proprioception_embedding = torch.nn.Linear(self.proprioception_dim, self.d_model)
         self.action_embedding = torch.nn.Linear(self.action_dim, self.d_model)
         self.position_embedding = nn.Embedding(self.sequence_length, self.d_model)
@@ -106,6 +127,9 @@ class EmbeddingNetwork(nn.Module):
     def vision_embed(self, x):
         return self.vision_embedding(x)
 
+    def vision_embed_sequence(self, x):
+        return self.vision_embedding.forward_sequence(x, self.vision_micro_batch_size)
+
     def proprioception_embed(self, x):
         return self.proprioception_embedding(x)
 
@@ -219,7 +243,7 @@ class PlanProposal(nn.Module):
     def forward(self, vision_embedded, proprioception_embedded, goal_embedded):
 
         x = torch.cat(
-            [vision_embedded, proprioception_embedded, goal_embedded], dim=1)  # (bs, 3*d_model)
+            [vision_embedded, proprioception_embedded, goal_embedded], dim=-1)  # (bs, 3*d_model) or (bs, seq_len, 3*d_model)
         x = self.fc(x)
         mu = self.fc_mu(x)
         sigma = F.softplus(self.fc_sigma(x)+self.epsilon)
@@ -315,12 +339,41 @@ class Actor(nn.Module):
         init_linear(self.mu)
         init_linear(self.sigma)
 
+        # built once for the longest sequence, get_action_step attends over 2 tokens per step plus latent and goal
+        self.register_buffer("causal_mask_buffer", self._causal_mask(2*self.sequence_length + 2), persistent=False)
+        self.register_buffer("sequence_mask_buffer", self._sequence_mask(self.sequence_length), persistent=False)
+
+    @staticmethod
+    def _causal_mask(size, device=None):
+        return torch.triu(torch.ones(size, size, dtype=torch.bool, device=device), diagonal=1)
+
+    @staticmethod
+    def _sequence_mask(sequence_length, device=None):
+        """
+        Attention mask of forward_sequence over (vision_1, pro_1, ..., vision_T, pro_T) followed by
+        (latent_1, goal, ..., latent_T, goal): the states attend causally to each other, and the latent
+        and goal of step t attend to the states up to step t and causally within their pair.
+        """
+        n = 2*sequence_length
+        step = torch.arange(n, device=device) // 2
+        allowed = torch.zeros(2*n, 2*n, dtype=torch.bool, device=device)
+        allowed[:n, :n] = ~Actor._causal_mask(n, device)
+        allowed[n:, :n] = step[None, :] <= step[:, None]
+        allowed[n:, n:] = (step[None, :] == step[:, None]) & ~Actor._causal_mask(n, device)
+        return ~allowed
+
+    def sequence_mask(self, sequence_length):
+        if sequence_length == self.sequence_length:
+            return self.sequence_mask_buffer
+        return self._sequence_mask(sequence_length, self.sequence_mask_buffer.device)
+
     def causal_mask(self, size):
         """
         Create a causal mask to prevent positions from attending to future positions.
         """
-        mask = torch.triu(torch.ones(size, size, device=self.device), diagonal=1).bool()
-        return mask
+        if size <= self.causal_mask_buffer.shape[0]:
+            return self.causal_mask_buffer[:size, :size]
+        return self._causal_mask(size, self.causal_mask_buffer.device)
 
     def forward(self, vision_embedded, proprioception_embedded, latent, goal_embedded, action_embedded, position_embedded):
 
@@ -354,9 +407,34 @@ class Actor(nn.Module):
         # Use the last decoder output for generating the action
         x = x[:, -1, :]  # (bs, d_model)
 
-        weightings = self.alpha(x).view(-1, self.action_dim, self.num_distribs)
-        mu = self.mu(x).view(-1, self.action_dim, self.num_distribs)
-        scale = nn.functional.softplus(self.sigma(x)+self.epsilon).view(-1, self.action_dim, self.num_distribs)
+        return self.action_distribution(x)
+
+    def forward_sequence(self, vision_embedded, proprioception_embedded, latent, goal_embedded):
+        """
+        Action distributions for every timestep of a sequence in one pass, as get_action_step returns
+        them one step at a time from the start of the sequence.
+        The tokens look like (vision_1, pro_1, ..., vision_T, pro_T, latent_1, goal, ..., latent_T, goal),
+        vision and pro carry the position embedding of their step, and sequence_mask lets the latent
+        and goal of step t see only the states up to t, so they are never part of another step's context.
+        latent: (bs, seq_len, latent_dim), goal_embedded: (bs, d_model)
+        """
+        batch_size, sequence_length = vision_embedded.shape[:2]
+        position_embedded = self.embedding.position_embed(torch.arange(sequence_length, device=vision_embedded.device))
+        states = torch.stack((vision_embedded, proprioception_embedded), dim=2) + position_embedded[None, :, None, :]
+
+        goal_embedded = goal_embedded.unsqueeze(1).expand(batch_size, sequence_length, self.d_model)
+        branches = torch.stack((latent, goal_embedded), dim=2)
+
+        x = torch.cat((states, branches), dim=1).reshape(batch_size, 4*sequence_length, self.d_model)  # (bs, 4*seq_len, d_model)
+        x = self.transformer_encoder(x, mask=self.sequence_mask(sequence_length))
+        x = x[:, 2*sequence_length + 1::2, :]  # (bs, seq_len, d_model) at the goal tokens
+
+        return self.action_distribution(x)
+
+    def action_distribution(self, x):
+        weightings = self.alpha(x).view(*x.shape[:-1], self.action_dim, self.num_distribs)
+        mu = self.mu(x).view(*x.shape[:-1], self.action_dim, self.num_distribs)
+        scale = nn.functional.softplus(self.sigma(x)+self.epsilon).view(*x.shape[:-1], self.action_dim, self.num_distribs)
         logistic_mixture = LogisticMixture(weightings, mu, scale)
 
         return logistic_mixture
@@ -393,6 +471,110 @@ class Actor(nn.Module):
 
         return action, action_log_prob
 
+    def init_cache(self, batch_size):
+        """
+        Empty cache for get_action_step: keys and values of every encoder layer for up to
+        sequence_length (vision, pro) steps plus the latent and goal tokens, and the steps themselves
+        for re-encoding after eviction.
+        """
+        device = self.causal_mask_buffer.device
+        shape = (batch_size, self.nhead, 2*self.sequence_length + 2, self.d_model // self.nhead)
+        num_layers = len(self.transformer_encoder.layers)
+        return dict(
+            keys=[torch.zeros(shape, device=device) for _ in range(num_layers)],
+            values=[torch.zeros(shape, device=device) for _ in range(num_layers)],
+            steps=torch.zeros((batch_size, self.sequence_length, 2, self.d_model), device=device),
+            length=0,
+        )
+
+    @torch.no_grad()
+    def get_action_step(self, vision_embedded, proprioception_embedded, latent, goal_embedded, cache=None):
+        """
+        Incremental counterpart of get_action for closed-loop control.
+        Only the newest (vision, pro) pair is encoded, attending to the cached keys and values of the
+        earlier ones, and then latent and goal, which attend to the cache without being added to it.
+        Steps keep the position they were encoded at and attend causally to earlier steps. Once the
+        window holds sequence_length steps the oldest half is evicted and the rest re-encoded from
+        position zero, so each step costs attention over the window instead of over its square.
+        vision_embedded, proprioception_embedded, latent, goal_embedded: (bs, d_model)
+        cache: cache returned by the previous call, None at the start of an episode
+        """
+        if cache is None:
+            cache = self.init_cache(vision_embedded.shape[0])
+        if cache['length'] == self.sequence_length:
+            self._evict(cache)
+
+        step = cache['length']
+        position_embedded = self.embedding.position_embed(torch.tensor([step], device=vision_embedded.device))
+        x = torch.stack((vision_embedded, proprioception_embedded), dim=1)  # (bs, 2, d_model)
+        cache['steps'][:, step] = x
+        self._encode_cached(x + position_embedded, cache, 2*step)
+        cache['length'] = step + 1
+
+        x = torch.stack((latent, goal_embedded), dim=1)  # (bs, 2, d_model)
+        x = self._encode_cached(x, cache, 2*step + 2)
+
+        logistic_mixture = self.action_distribution(x[:, -1, :])
+        action = logistic_mixture.sample()
+        action_log_prob = logistic_mixture.log_prob(action)
+
+        return action, action_log_prob, cache
+
+    def _evict(self, cache):
+        """
+        Drop the oldest half of the cached steps and re-encode the others from position zero.
+        """
+        keep = self.sequence_length // 2
+        cache['length'] = keep
+        if keep == 0:
+            return
+        steps = cache['steps'][:, self.sequence_length - keep:].clone()
+        cache['steps'][:, :keep] = steps
+        position_embedded = self.embedding.position_embed(torch.arange(keep, device=steps.device))
+        x = (steps + position_embedded[None, :, None, :]).reshape(steps.shape[0], 2*keep, self.d_model)
+        self._encode_cached(x, cache, 0)
+
+    def _encode_cached(self, x, cache, start):
+        """
+        Run the tokens x (bs, n, d_model) at positions start.. through the encoder, attending to the
+        cached tokens before them and causally to each other, and write their keys and values to the cache.
+        """
+        n = x.shape[1]
+        # the mask marks future tokens, scaled_dot_product_attention expects the allowed ones
+        attn_mask = ~self.causal_mask(start + n)[start:]
+        for layer, keys, values in zip(self.transformer_encoder.layers, cache['keys'], cache['values']):
+            if layer.norm_first:
+                x = x + self._cached_attention(layer, layer.norm1(x), keys, values, start, attn_mask)
+                x = x + self._feed_forward(layer, layer.norm2(x))
+            else:
+                x = layer.norm1(x + self._cached_attention(layer, x, keys, values, start, attn_mask))
+                x = layer.norm2(x + self._feed_forward(layer, x))
+        if self.transformer_encoder.norm is not None:
+            x = self.transformer_encoder.norm(x)
+        return x
+
+    def _cached_attention(self, layer, x, keys, values, start, attn_mask):
+        """
+        Self-attention block of an nn.TransformerEncoderLayer over the cached tokens and x.
+        """
+        self_attn = layer.self_attn
+        batch_size, n, _ = x.shape
+        q, k, v = F.linear(x, self_attn.in_proj_weight, self_attn.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = [t.view(batch_size, n, self.nhead, -1).transpose(1, 2) for t in (q, k, v)]  # (bs, nhead, n, head_dim)
+        keys[:, :, start:start + n] = k
+        values[:, :, start:start + n] = v
+
+        x = F.scaled_dot_product_attention(q, keys[:, :, :start + n], values[:, :, :start + n], attn_mask=attn_mask,
+                                           dropout_p=self_attn.dropout if self.training else 0.0)
+        x = self_attn.out_proj(x.transpose(1, 2).reshape(batch_size, n, self.d_model))
+        return layer.dropout1(x)
+
+    def _feed_forward(self, layer, x):
+        """
+        Feed-forward block of an nn.TransformerEncoderLayer.
+        """
+        return layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x)))))
+
 
 class Critic(nn.Module):
     def __init__(self, layer_size=1024):
@@ -1,36 +1,60 @@
+import os
+import hashlib
 import torch
 import torch.distributions.kl as kl
+from torch.distributions import Normal
 import matplotlib.pyplot as plt
 from sklearn.manifold import TSNE
 import h5py
 from mani_skill.utils.io_utils import load_json
 from mani_skill.utils.common import flatten_state_dict
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from tqdm.notebook import tqdm
 import numpy as np
+from collections import OrderedDict
+import parameters as params
 
 class ManiSkillDataset(Dataset):
-    def __init__(self, dataset_file: str, load_count=-1) -> None:
+    def __init__(self, dataset_file: str, load_count=-1, lazy=False, cache_size=32, windowed=False,
+                 preprocessed_dir=None) -> None:
         self.dataset_file = dataset_file
         # for details on how the code below works, see the
         # quick start tutorial
-        self.data = h5py.File(dataset_file, "r")
+        # the file is opened on first access in each process, see `data`
+        self._data, self._data_pid = None, None
         json_path = dataset_file.replace(".h5", ".json")
         self.json_data = load_json(json_path)
         self.episodes = self.json_data["episodes"]
         self.env_info = self.json_data["env_info"]
         self.env_id = self.env_info["env_id"]
         self.env_kwargs = self.env_info["env_kwargs"]
+        # in lazy mode only episode offsets are read here, episodes are read on access and
+        # the last `cache_size` of them are kept (per DataLoader worker, as each has its own copy)
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # with `preprocessed_dir` set, episodes are served from rescaled channel-first arrays
+        # written there once, instead of being read from the .h5 file and converted every time
+        self.preprocessed_dir = preprocessed_dir
 
         self.obs_state = []
         self.obs_rgbd = []
         self.actions = []
+        self.episode_index = []
         self.total_frames = 0
         if load_count == -1:
             load_count = len(self.episodes)
+        self.load_count = load_count
         for eps_id in tqdm(range(load_count)):
             eps = self.episodes[eps_id]
             trajectory = self.data[f"traj_{eps['episode_id']}"]
+            if self.lazy or self.preprocessed_dir is not None:
+                # the shape comes from the dataset header, no frames are read
+                length = trajectory["actions"].shape[0]
+                self.episode_index.append(dict(key=f"traj_{eps['episode_id']}", offset=self.total_frames, length=length))
+                self.total_frames += length
+                continue
+
             trajectory = self.load_h5_data(trajectory)
 
             # convert the original raw observation with our batch-aware function
@@ -40,6 +64,103 @@ class ManiSkillDataset(Dataset):
             self.obs_rgbd.append(obs['rgbd'][:-1])
             self.obs_state.append(obs['state'][:-1])
             self.actions.append(trajectory["actions"])
+            self.total_frames += len(trajectory["actions"])
+
+        # in windowed mode every item is the window of `window_length` steps ending at one step of
+        # one episode, left-padded with zeros where the episode is shorter
+        self.windowed = windowed
+        self.window_length = params.sequence_length
+        if self.windowed:
+            lengths = [episode["length"] for episode in self.episode_index] if self.episode_index else \
+                [len(actions) for actions in self.actions]
+            self.windows = np.concatenate([
+                np.stack([np.full(length, eps_id), np.arange(1, length + 1)], axis=1)
+                for eps_id, length in enumerate(lengths)]).astype(np.int64)
+
+        self.preprocessed = None
+        if self.preprocessed_dir is not None:
+            self.preprocessed = self.load_preprocessed(load_count)
+        # DataLoader workers open their own handle, eager and preprocessed data never read it again
+        self.close()
+
+    @property
+    def data(self):
+        # h5py handles cannot be shared between processes, so a worker started by fork
+        # opens a new one instead of using the handle inherited from its parent
+        if self._data is None or self._data_pid != os.getpid():
+            self._data = h5py.File(self.dataset_file, "r")
+            self._data_pid = os.getpid()
+        return self._data
+
+    def close(self):
+        if self._data is not None and self._data_pid == os.getpid():
+            self._data.close()
+        self._data, self._data_pid = None, None
+
+    def __getstate__(self):
+        # workers started by spawn reopen the file and memory maps instead of receiving copies
+        state = self.__dict__.copy()
+        state.update(_data=None, _data_pid=None, preprocessed=None, cache=OrderedDict())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.preprocessed_dir is not None:
+            self.preprocessed = self.load_preprocessed(self.load_count)
+
+    def item_episodes(self):
+        # episode each item is read from
+        if self.windowed:
+            return self.windows[:, 0]
+        return np.arange(len(self))
+
+    def preprocessed_path(self, load_count, chunk_bytes=2**24):
+        # keyed by the source file's name and a digest of its whole content, so any edit to the
+        # .h5 file gets a new cache; the file is read once here, in chunks
+        stat = os.stat(self.dataset_file)
+        digest = hashlib.sha1()
+        with open(self.dataset_file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_bytes), b""):
+                digest.update(chunk)
+        key = "{}:{}:{}:{}:{}".format(os.path.basename(self.dataset_file), stat.st_size, stat.st_mtime_ns,
+                                      digest.hexdigest(), load_count)
+        return os.path.join(self.preprocessed_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def load_preprocessed(self, load_count):
+        path = self.preprocessed_path(load_count)
+        if not os.path.exists(path):
+            self.write_preprocessed(path)
+        # copy-on-write maps are writable, so torch.from_numpy can wrap them without copying
+        return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="c")
+                for name in ("rgbd", "state", "action", "offsets")}
+
+    def write_preprocessed(self, path):
+        if not self.episode_index:
+            raise ValueError("no episodes to preprocess in {}".format(self.dataset_file))
+        # written to a temporary directory first so an interrupted run leaves no partial cache
+        tmp_path = path + ".tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        offsets = np.array([0] + [episode["length"] for episode in self.episode_index]).cumsum()
+        arrays = None
+        for eps_id in tqdm(range(len(self.episode_index))):
+            rgbd, state, action = self.load_episode(eps_id)
+            rgbd = self.rescale_rgbd(rgbd).squeeze(1).transpose(0, 3, 1, 2).astype(np.float16)
+            state = state.squeeze(1).astype(np.float32)
+            if arrays is None:
+                arrays = dict(
+                    rgbd=np.lib.format.open_memmap(os.path.join(tmp_path, "rgbd.npy"), mode="w+",
+                                                   dtype=np.float16, shape=(self.total_frames, *rgbd.shape[1:])),
+                    state=np.lib.format.open_memmap(os.path.join(tmp_path, "state.npy"), mode="w+",
+                                                    dtype=np.float32, shape=(self.total_frames, *state.shape[1:])),
+                    action=np.lib.format.open_memmap(os.path.join(tmp_path, "action.npy"), mode="w+",
+                                                     dtype=np.float32, shape=(self.total_frames, *action.shape[1:])))
+            arrays["rgbd"][offsets[eps_id]:offsets[eps_id + 1]] = rgbd
+            arrays["state"][offsets[eps_id]:offsets[eps_id + 1]] = state
+            arrays["action"][offsets[eps_id]:offsets[eps_id + 1]] = action
+        for array in arrays.values():
+            array.flush()
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        os.replace(tmp_path, path)
 
     # loads h5 data into memory for faster access
     def load_h5_data(self, data):
@@ -51,6 +172,34 @@ class ManiSkillDataset(Dataset):
                 out[k] = self.load_h5_data(data[k])
         return out
 
+    def load_episode(self, idx):
+        # reads only the arrays convert_observation uses, without the terminal observation
+        trajectory = self.data[self.episode_index[idx]["key"]]
+        length = self.episode_index[idx]["length"]
+        observation = trajectory["obs"]
+        obs = self.convert_observation(dict(
+            sensor_data=dict(base_camera=dict(
+                rgb=observation["sensor_data/base_camera/rgb"][:length],
+                depth=observation["sensor_data/base_camera/depth"][:length])),
+            extra=dict(tcp_pose=observation["extra/tcp_pose"][:length])))
+        return obs['rgbd'], obs['state'], trajectory["actions"][:]
+
+    def get_episode(self, idx):
+        if self.preprocessed_dir is not None:
+            start, end = self.preprocessed["offsets"][idx:idx + 2]
+            return tuple(self.preprocessed[name][start:end] for name in ("rgbd", "state", "action"))
+        if not self.lazy:
+            return self.obs_rgbd[idx], self.obs_state[idx], self.actions[idx]
+
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+        episode = self.load_episode(idx)
+        self.cache[idx] = episode
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return episode
+
     def convert_observation(self, observation):
         # flattens the original observation by flattening the state dictionaries
         # and combining the rgb and depth images
@@ -73,21 +222,120 @@ class ManiSkillDataset(Dataset):
         return np.concatenate([rgb, depth], axis=-1)
 
     def __len__(self):
+        if self.windowed:
+            return len(self.windows)
+        if self.episode_index:
+            return len(self.episode_index)
         return len(self.obs_rgbd)
 
     def __getitem__(self, idx):
-        action = torch.from_numpy(self.actions[idx]).float()
+        if not self.windowed:
+            return self.make_item(*self.get_episode(idx))
+
+        eps_id, end = self.windows[idx]
+        start = max(0, end - self.window_length)
+        rgbd, state, action = self.get_episode(eps_id)
+        item = self.make_item(rgbd[start:end], state[start:end], action[start:end])
+
+        padding = self.window_length - (end - start)
+        item = {key: left_pad(value, padding) for key, value in item.items()}
+        item["mask"] = left_pad(torch.ones(end - start), padding)
+        return item
+
+    def make_item(self, rgbd, state, action):
+        if self.preprocessed_dir is not None:
+            # views of the preprocessed arrays, rgbd stays float16 until it reaches the device
+            return dict(rgbd=torch.from_numpy(rgbd), state=torch.from_numpy(state), action=torch.from_numpy(action))
+
+        action = torch.from_numpy(action).float()
 
-        rgbd = self.obs_rgbd[idx]
         rgbd = self.rescale_rgbd(rgbd)
         rgbd = torch.from_numpy(rgbd).squeeze(1).permute(0, 3, 1, 2).float()
 
-        state = self.obs_state[idx]
         state = torch.from_numpy(state).squeeze(1)
         state = torch.FloatTensor(state)
 
         return dict(rgbd=rgbd, state=state, action=action)
-    
+
+class ShardedBatchSampler(Sampler):
+    # DataLoader hands batch k to worker k % num_workers, so batches are interleaved such that
+    # each worker only reads the episodes of its own shard and keeps them in its episode cache;
+    # episodes are visited in groups of `dataset.cache_size` with items shuffled within a group
+    def __init__(self, dataset, batch_size, num_workers, shuffle=True, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_shards = max(1, num_workers)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def shard_batches(self, shard):
+        item_episodes = self.dataset.item_episodes()
+        episodes = np.unique(item_episodes)[shard::self.num_shards]
+        if self.shuffle:
+            episodes = np.random.permutation(episodes)
+
+        items = []
+        for i in range(0, len(episodes), self.dataset.cache_size):
+            group = np.flatnonzero(np.isin(item_episodes, episodes[i:i + self.dataset.cache_size]))
+            items.append(np.random.permutation(group) if self.shuffle else group)
+        items = np.concatenate(items) if items else np.zeros(0, dtype=np.int64)
+
+        batches = [items[i:i + self.batch_size].tolist() for i in range(0, len(items), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __iter__(self):
+        shards = [self.shard_batches(shard) for shard in range(self.num_shards)]
+        for k in range(max(len(batches) for batches in shards)):
+            for batches in shards:
+                if k < len(batches):
+                    yield batches[k]
+
+    def __len__(self):
+        item_episodes = self.dataset.item_episodes()
+        length = 0
+        for shard in range(self.num_shards):
+            count = np.isin(item_episodes, np.unique(item_episodes)[shard::self.num_shards]).sum()
+            length += count // self.batch_size if self.drop_last else -(-count // self.batch_size)
+        return int(length)
+
+def left_pad(tensor, padding):
+    # prepends `padding` zero steps along the first dimension
+    if padding == 0:
+        return tensor
+    return torch.cat([tensor.new_zeros((padding, *tensor.shape[1:])), tensor], dim=0)
+
+def collate_windows(batch):
+    # stacks windowed items into contiguous [batch, window_length, ...] tensors,
+    # mask is 1 for real steps and 0 for left padding and is passed on to `AgentTrainer.pre_train`
+    return {key: torch.stack([item[key] for item in batch], dim=0) for key in batch[0]}
+
+def iter_demonstrations(dataset_file: str, load_count=-1):
+    # streams episodes of a ManiSkill .h5/.json pair one at a time as the arrays
+    # `ReplayBuffer.store_many` takes, with vision rescaled to float32 [length + 1, 4, H, W]
+    episodes = load_json(dataset_file.replace(".h5", ".json"))["episodes"]
+    if load_count == -1:
+        load_count = len(episodes)
+    with h5py.File(dataset_file, "r") as data:
+        for eps in tqdm(episodes[:load_count]):
+            trajectory = data[f"traj_{eps['episode_id']}"]
+            observation = trajectory["obs"]
+            rgb = observation["sensor_data/base_camera/rgb"][:]
+            depth = observation["sensor_data/base_camera/depth"][:]
+            vision = np.concatenate([rgb.astype(np.float32) / 255.0, depth.astype(np.float32) / (2**10)], axis=-1)
+            vision = vision.reshape(-1, *vision.shape[-3:]).transpose(0, 3, 1, 2)
+            proprioception = observation["extra/tcp_pose"][:].reshape(len(vision), -1)
+
+            action = trajectory["actions"][:]
+            reward = trajectory["rewards"][:] if "rewards" in trajectory else np.zeros(len(action), dtype=np.float32)
+            if "terminated" in trajectory:
+                done = trajectory["terminated"][:].astype(np.float32)
+            else:
+                done = np.zeros(len(action), dtype=np.float32)
+                done[-1] = 1
+            yield vision, proprioception, action, reward, done
+
 def convert_demonstration(data_bacth):
 
     actions = data_bacth["action"]
@@ -96,14 +344,31 @@ def convert_demonstration(data_bacth):
 
     return actions, video, proprioception
 
-def convert_observation(observation):
+# per-channel scales keyed by (channels per frame, device, dtype)
+_rgbd_scales = {}
 
+def preprocess_rgbd(images, device=None, dtype=torch.float32):
+    # moves raw channel-last camera frames (uint8 RGB, uint16 depth, in that order per camera)
+    # to the device (params.device by default), then scales and stacks them into one [..., C, H, W]
+    # tensor of `dtype` there; works for single frames [H, W, c] as well as batches or sequences of them
+    device = torch.device(params.device if device is None else device)
+    frames = [torch.as_tensor(image).to(device, non_blocking=True) for image in images]
+    channels = tuple(frame.shape[-1] for frame in frames)
+    key = (channels, device, dtype)
+    if key not in _rgbd_scales:
+        # RGB frames have 3 channels scaled by 1/255, depth frames 1 channel scaled by 1/2**10
+        _rgbd_scales[key] = torch.tensor([1 / 255.0 if c == 3 else 1 / 2**10 for c in channels for _ in range(c)],
+                                         dtype=dtype, device=device)
+    vision = torch.cat([frame.to(dtype) for frame in frames], dim=-1).mul_(_rgbd_scales[key])
+    return vision.movedim(-1, -3).contiguous()
+
+def convert_observation(observation, device=None):
+    # returns vision [..., 4, H, W] and proprioception as float32 torch tensors on `device`
+    # (params.device by default), not numpy arrays, so callers no longer convert or move them
+    device = params.device if device is None else device
     image_obs = observation["sensor_data"]
-    rgb = image_obs["base_camera"]["rgb"] / 255.0
-    depth = image_obs["base_camera"]["depth"] / (2**10)
-    vision = np.concatenate([rgb, depth], axis=-1)
-    vision = vision.transpose(0, 3, 1, 2)
-    proprioception = observation['extra']['tcp_pose']
+    vision = preprocess_rgbd([image_obs["base_camera"]["rgb"], image_obs["base_camera"]["depth"]], device)
+    proprioception = torch.as_tensor(observation['extra']['tcp_pose']).to(device).float()
 
     return vision, proprioception
 
@@ -112,13 +377,24 @@ def compute_loss(labels, predictions):
     nll = torch.mean(nll, dim=0)   # average over batch
     return nll
 
-def compute_regularisation_loss(recognition, proposal):
-    """ Reverse KL(enc|plan): we want recognition to map to proposal """
+def compute_regularisation_loss(recognition, proposal, mask=None):
+    """ Reverse KL(enc|plan): we want recognition to map to proposal, mask [batch_size] zeroes padded samples """
     reg_loss = kl.kl_divergence(recognition, proposal) # [batch_size, latent_dim]
     reg_loss = torch.sum(reg_loss, dim=1) # sum over latent space
+    if mask is not None:
+        reg_loss = reg_loss * mask
     average_loss = torch.mean(reg_loss, dim=0) # average over batch
     return average_loss
 
+def compute_sequence_regularisation_loss(recognition, proposal, mask=None):
+    """ compute_regularisation_loss summed over the timesteps of a per-timestep proposal, mask [batch_size, seq_len] """
+    recognition = Normal(recognition.loc.unsqueeze(1), recognition.scale.unsqueeze(1))
+    reg_loss = kl.kl_divergence(recognition, proposal) # [batch_size, seq_len, latent_dim]
+    reg_loss = torch.sum(reg_loss, dim=-1) # sum over latent space
+    if mask is not None:
+        reg_loss = reg_loss * mask
+    return torch.mean(reg_loss, dim=0).sum() # average over batch, sum over time
+
 def plot_latent_space(encoder, vision_network, video_batch, proprioception_batch, action_batch):
     """ Visualize the latent space using t-SNE """
     tsne = TSNE(n_components=2, perplexity=30, n_iter=1000, random_state=42)  # 2D t-SNE, adjust parameters as needed
@@ -126,7 +402,7 @@ def plot_latent_space(encoder, vision_network, video_batch, proprioception_batch
     sequence_length = video_batch.shape[1]
     latent_samples = []
     for i in range(batch_size):
-        video_embeded = torch.stack([vision_network(video_batch[i, j, :]) for j in range(sequence_length)], dim=1)
+        video_embeded = vision_network.forward_sequence(video_batch[i:i + 1])[0]
         combined = torch.cat([video_embeded, proprioception_batch[i], action_batch[i]], dim=-1)
         dist = encoder(combined)
         latent = dist.sample()
@@ -21,9 +21,9 @@ class DecisionTransformer(nn.Module):
             **kwargs
     ):
         super().__init__()
-            self.state_dim = state_dim
-            self.act_dim = act_dim
-            self.max_length = max_length
+        self.state_dim = state_dim
+        self.act_dim = act_dim
+        self.max_length = max_length
 
         self.hidden_size = hidden_size
         config = transformers.GPT2Config(
@@ -137,3 +137,107 @@ class DecisionTransformer(nn.Module):
             states, actions, None, returns_to_go, timesteps, attention_mask=attention_mask, **kwargs)
 
         return action_preds[0,-1]
+
+    def rollout_session(self, keep=None):
+        """
+        Incremental counterpart of get_action for evaluation rollouts, see RolloutSession.
+        """
+        return RolloutSession(self, keep=keep)
+
+
+class RolloutSession():
+
+    """
+    Keeps the GPT past_key_values of one episode so that each step only runs the new tokens
+    (a_{t-1}, R_t, s_t, a_t) through the transformer instead of the whole padded window.
+    a_t is the zero placeholder get_action is called with, its prediction is the action, and it is
+    dropped from the cache again so that the action actually taken replaces it on the next step.
+    Padded tokens are masked out and there are no positional embeddings, so until the context holds
+    max_length steps this returns the same action as get_action on the full history. Then the cache
+    is rebuilt from the newest `keep` steps (max_length // 2 by default) instead of sliding by one,
+    which would re-encode the window every step since later layers depend on the evicted tokens.
+    """
+
+    def __init__(self, model, keep=None):
+        self.model = model
+        self.max_length = model.max_length
+        if keep is None:
+            keep = self.max_length // 2 if self.max_length is not None else 0
+        self.keep = keep
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new episode.
+        """
+        self.past_key_values = None
+        self.tokens = None  # embedded tokens in the cache, for re-prefill
+        self.length = 0  # steps in the context, including the one waiting for its action
+        self.pending_action = None
+        self.time_embeddings = None
+
+    def set_action(self, action):
+        """
+        Replace the action of the last step, by default the predicted one, with the one actually taken.
+        """
+        self.pending_action = action.reshape(self.model.act_dim)
+
+    @torch.no_grad()
+    def get_action(self, state, return_to_go, timestep):
+        """
+        state: (state_dim), return_to_go: (1), timestep: scalar long tensor
+        """
+        model = self.model
+        device = state.device
+        state = state.reshape(1, model.state_dim).to(dtype=torch.float32)
+        return_to_go = return_to_go.reshape(1, 1).to(dtype=torch.float32)
+        timestep = timestep.reshape(1).to(dtype=torch.long, device=device)
+
+        # time embeddings are treated similar to positional embeddings
+        time_embeddings = model.embed_timestep(timestep)
+        new_tokens = [
+            model.embed_return(return_to_go) + time_embeddings,
+            model.embed_state(state) + time_embeddings,
+            model.embed_action(torch.zeros((1, model.act_dim), device=device)) + time_embeddings,
+        ]
+        if self.pending_action is not None:
+            action = self.pending_action.reshape(1, model.act_dim).to(dtype=torch.float32)
+            new_tokens.insert(0, model.embed_action(action) + self.time_embeddings)
+        # embed_ln normalizes each token on its own, so tokens can be embedded one step at a time
+        new_tokens = model.embed_ln(torch.cat(new_tokens, dim=0))[None]
+
+        if self.max_length is not None and self.length == self.max_length:
+            self.prefill(new_tokens)
+        else:
+            self.run(new_tokens)
+        self.length += 1
+        self.time_embeddings = time_embeddings
+
+        action_preds = model.predict_action(self.last_hidden_state)
+        self.pending_action = action_preds.reshape(model.act_dim)
+        return self.pending_action
+
+    def prefill(self, new_tokens):
+        """
+        Drop the cache and encode the newest `keep` complete steps followed by new_tokens.
+        """
+        # the cache holds whole (R, s, a) steps, the last one's action being the first new token
+        tokens = torch.cat([self.tokens, new_tokens[:, :1]], dim=1)
+        tokens = tokens[:, tokens.shape[1] - 3*self.keep:]
+        self.past_key_values = None
+        self.tokens = None
+        self.length = self.keep
+        self.run(torch.cat([tokens, new_tokens[:, 1:]], dim=1))
+
+    def run(self, new_tokens):
+        transformer_outputs = self.model.transformer(
+            inputs_embeds=new_tokens,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+        )
+        self.last_hidden_state = transformer_outputs['last_hidden_state'][0, -1]
+
+        # leave the placeholder action out, the action taken is fed with the next step
+        self.past_key_values = tuple(present[..., :-1, :] for present in transformer_outputs['past_key_values'])
+        new_tokens = new_tokens[:, :-1]
+        self.tokens = new_tokens if self.tokens is None else torch.cat([self.tokens, new_tokens], dim=1)
@@ -37,29 +37,32 @@ class VisionNetwork(nn.Module):
             self.fc = nn.Sequential(nn.Linear(2*C, 512),
                                 nn.ReLU(),
                                 nn.Linear(512, self.out_dim))
+
+        # [H*W, 2] spatial softmax grid, other feature map sizes get theirs on first use
+        self.register_buffer("image_coords", self._image_coords(H, W), persistent=False)
+        self.extra_image_coords = {}
     
+    def _image_coords(self, H, W, device=None):
+        x_coords = torch.linspace(0, 1, W, device=device)
+        y_coords = torch.linspace(0, 1, H, device=device)
+        X, Y = torch.meshgrid(x_coords, y_coords, indexing='xy')
+        return torch.stack([X, Y], dim=-1).view(H * W, 2)
+
     def _spatial_softmax(self, pre_softmax):
         N, C, H, W = pre_softmax.shape
-        pre_softmax = pre_softmax.view(N*C, H * W)
-        softmax = F.softmax(pre_softmax, dim=1)
-        softmax = softmax.view(N, C, H, W)
+        softmax = F.softmax(pre_softmax.reshape(N, C, H * W), dim=-1)
 
-        # Create normalized meshgrid
-        x_coords = torch.linspace(0, 1, W, device=self.device)
-        y_coords = torch.linspace(0, 1, H, device=self.device)
-        X, Y = torch.meshgrid(x_coords, y_coords, indexing='xy')
-        image_coords = torch.stack([X, Y], dim=-1).to(self.device)  # [H, W, 2]
-
-        image_coords = image_coords.unsqueeze(0)  # [1, H, W, 2]
-        image_coords = image_coords.unsqueeze(0)  # [1, H, W, 2] -> [1, 1, H, W, 2]
-        
-        # Reshape softmax for broadcasting
-        softmax = softmax.unsqueeze(-1)  # [N, C, H, W, 1]
+        image_coords = self.image_coords
+        if image_coords.shape[0] != H * W or image_coords.device != softmax.device:
+            key = (H, W, softmax.device)
+            if key not in self.extra_image_coords:
+                self.extra_image_coords[key] = self._image_coords(H, W, softmax.device)
+            image_coords = self.extra_image_coords[key]
 
         # Compute spatial soft argmax
         # This tensor represents the 'center of mass' for each channel of each feature map in the batch
-        spatial_soft_argmax = torch.sum(softmax * image_coords, dim=[2, 3])  # [N, C, 2]
-        x = nn.Flatten()(spatial_soft_argmax)  # [N, C, 2] -> [N, 2*C]
+        spatial_soft_argmax = torch.matmul(softmax, image_coords.to(softmax.dtype))  # [N, C, 2]
+        x = spatial_soft_argmax.reshape(N, 2 * C)  # [N, C, 2] -> [N, 2*C]
         return x
 
     def forward(self, x):
@@ -1,22 +1,22 @@
 
-import random
 import numpy as np
 from typing import Dict, List
 from segment_tree import MinSegmentTree, SumSegmentTree
 
 class ReplayBuffer:
-    """A simple numpy replay buffer."""
+    """A simple numpy replay buffer.
+
+    Frames are kept once per sequence plus one terminal frame, and the next observations are
+    read back as the same frames shifted by one step.
+    """
 
     def __init__(self, vision_dim, pos_dim: int, quat_dim: int, acts_dim: int, size: int, sequence_length: int = 100, batch_size: int = 1024):
         self.sequence_length = sequence_length
 
-        self.vision_buf = np.zeros([size, sequence_length, *vision_dim], dtype=np.float32)
-        self.pos_buf = np.zeros([size, sequence_length, pos_dim], dtype=np.float32)
-        self.quat_buf = np.zeros([size, sequence_length, quat_dim], dtype=np.float32)
-
-        self.next_vision_buf = np.zeros([size, sequence_length, *vision_dim], dtype=np.float32)
-        self.next_pos_buf = np.zeros([size, sequence_length, pos_dim], dtype=np.float32)
-        self.next_quat_buf = np.zeros([size, sequence_length, quat_dim], dtype=np.float32)
+        # sequence_length + 1 frames per slot: the last one is the terminal next observation
+        self.vision_buf = np.zeros([size, sequence_length + 1, *vision_dim], dtype=np.float32)
+        self.pos_buf = np.zeros([size, sequence_length + 1, pos_dim], dtype=np.float32)
+        self.quat_buf = np.zeros([size, sequence_length + 1, quat_dim], dtype=np.float32)
 
         self.acts_buf = np.zeros([size, sequence_length, acts_dim], dtype=np.float32)
         self.rews_buf = np.zeros([size, sequence_length], dtype=np.float32)
@@ -28,13 +28,14 @@ class ReplayBuffer:
         vision, pos, quat = obs['frontview_image'], obs['robot0_eef_pos'], obs['robot0_eef_quat']
         next_vision, next_pos, next_quat = next_obs['frontview_image'], next_obs['robot0_eef_pos'], next_obs['robot0_eef_quat']
 
-        self.vision_buf[self.ptr] = vision
-        self.pos_buf[self.ptr] = pos
-        self.quat_buf[self.ptr] = quat
+        # next_obs[t] is obs[t + 1], so only its last frame adds information
+        self.vision_buf[self.ptr, :-1] = vision
+        self.pos_buf[self.ptr, :-1] = pos
+        self.quat_buf[self.ptr, :-1] = quat
 
-        self.next_vision_buf[self.ptr] = next_vision
-        self.next_pos_buf[self.ptr] = next_pos
-        self.next_quat_buf[self.ptr] = next_quat
+        self.vision_buf[self.ptr, -1] = next_vision[-1]
+        self.pos_buf[self.ptr, -1] = next_pos[-1]
+        self.quat_buf[self.ptr, -1] = next_quat[-1]
         
         self.acts_buf[self.ptr] = act
         self.rews_buf[self.ptr] = rew
@@ -45,9 +46,16 @@ class ReplayBuffer:
 
     def sample_batch(self) -> Dict[str, np.ndarray]:
         idxs = np.random.choice(self.size, size=self.batch_size, replace=False)
+        return self._gather(idxs)
+
+    def _gather(self, idxs: np.ndarray) -> Dict[str, np.ndarray]:
+        """Gather sequences at idxs, rebuilding next observations by a one-frame offset."""
+        vision = self.vision_buf[idxs]
+        pos = self.pos_buf[idxs]
+        quat = self.quat_buf[idxs]
         return dict(
-            obs=self.obs_buf[idxs],
-            next_obs=self.next_obs_buf[idxs],
+            obs=dict(frontview_image=vision[:, :-1], robot0_eef_pos=pos[:, :-1], robot0_eef_quat=quat[:, :-1]),
+            next_obs=dict(frontview_image=vision[:, 1:], robot0_eef_pos=pos[:, 1:], robot0_eef_quat=quat[:, 1:]),
             acts=self.acts_buf[idxs],
             rews=self.rews_buf[idxs],
             done=self.done_buf[idxs]
@@ -118,60 +126,55 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         
         indices = self._sample_proportional()
         
-        obs = self.obs_buf[indices]
-        next_obs = self.next_obs_buf[indices]
-        acts = self.acts_buf[indices]
-        rews = self.rews_buf[indices]
-        done = self.done_buf[indices]
-        weights = np.array([self._calculate_weight(i, self.beta) for i in indices])
+        weights = self._calculate_weights(indices, self.beta)
         
         return dict(
-            obs=obs,
-            next_obs=next_obs,
-            acts=acts,
-            rews=rews,
-            done=done,
+            **self._gather(indices),
             weights=weights,
             indices=indices,
         )
         
     def update_priorities(self, indices: List[int], priorities: np.ndarray):
         """Update priorities of sampled transitions."""
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        priorities = np.asarray(priorities, dtype=np.float64).reshape(-1)
         assert len(indices) == len(priorities)
+        if len(indices) == 0:
+            return
 
-        for idx, priority in zip(indices, priorities):
-            assert priority > 0
-            assert 0 <= idx < len(self)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= indices) & (indices < len(self)))
 
-            self.sum_tree[idx] = priority ** self.alpha
-            self.min_tree[idx] = priority ** self.alpha
+        # both trees get the same leaves, so exponentiate once
+        priorities_alpha = priorities ** self.alpha
+        self.sum_tree[indices] = priorities_alpha
+        self.min_tree[indices] = priorities_alpha
 
-            self.max_priority = max(self.max_priority, priority)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
             
-    def _sample_proportional(self) -> List[int]:
+    def _sample_proportional(self) -> np.ndarray:
         """Sample indices based on proportions."""
-        indices = []
         p_total = self.sum_tree.sum(0, len(self) - 1)
         segment = p_total / self.batch_size
-        
-        for i in range(self.batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            upperbound = random.uniform(a, b)
-            idx = self.sum_tree.retrieve(upperbound)
-            indices.append(idx)
+
+        # one uniform draw inside each of the batch_size equal segments
+        upperbounds = (np.arange(self.batch_size) + np.random.uniform(size=self.batch_size)) * segment
+        indices = self.sum_tree.retrieve(upperbounds)
             
         return indices
     
-    def _calculate_weight(self, idx: int, beta: float):
-        """Calculate the weight of the experience at idx."""
+    def _calculate_weights(self, indices: np.ndarray, beta: float) -> np.ndarray:
+        """Calculate the weights of the experiences at indices."""
+        # read the root values once for the whole batch
+        p_total = self.sum_tree.sum()
+
         # get max weight
-        p_min = self.min_tree.min() / self.sum_tree.sum()
+        p_min = self.min_tree.min() / p_total
         max_weight = (p_min * len(self)) ** (-beta)
         
         # calculate weights
-        p_sample = self.sum_tree[idx] / self.sum_tree.sum()
-        weight = (p_sample * len(self)) ** (-beta)
-        weight = weight / max_weight
+        p_samples = self.sum_tree[indices] / p_total
+        weights = (p_samples * len(self)) ** (-beta)
+        weights = weights / max_weight
         
-        return weight
\ No newline at end of file
+        return weights.astype(np.float32)
\ No newline at end of file
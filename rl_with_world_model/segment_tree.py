@@ -2,7 +2,9 @@
 """Segment tree for Prioritized Replay Buffer."""
 
 import operator
-from typing import Callable
+from typing import Callable, Union
+
+import numpy as np
 
 
 class SegmentTree:
@@ -11,9 +13,13 @@ class SegmentTree:
     Taken from OpenAI baselines github repository:
     https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
 
+    The tree is stored in a flat numpy array so that leaves can be written and
+    read with index arrays, updating all ancestors one level at a time.
+
     Attributes:
         capacity (int)
-        tree (list)
+        depth (int): number of levels above the leaves
+        tree (np.ndarray)
         operation (function)
 
     """
@@ -23,7 +29,7 @@ class SegmentTree:
 
         Args:
             capacity (int)
-            operation (function)
+            operation (function): binary function that also works elementwise on arrays
             init_value (float)
 
         """
@@ -31,7 +37,8 @@ class SegmentTree:
             capacity > 0 and capacity & (capacity - 1) == 0
         ), "capacity must be positive and a power of 2."
         self.capacity = capacity
-        self.tree = [init_value for _ in range(2 * capacity)]
+        self.depth = capacity.bit_length() - 1
+        self.tree = np.full(2 * capacity, init_value, dtype=np.float64)
         self.operation = operation
 
     def _operate_helper(
@@ -58,21 +65,40 @@ class SegmentTree:
             end += self.capacity
         end -= 1
 
-        return self._operate_helper(start, end, 1, 0, self.capacity - 1)
+        return float(self._operate_helper(start, end, 1, 0, self.capacity - 1))
+
+    def __setitem__(self, idx: Union[int, np.ndarray], val: Union[float, np.ndarray]):
+        """Set value in tree.
+
+        `idx` may be a single index or an array of indices, in which case `val`
+        is broadcast against it and every ancestor is recomputed level by level.
+        """
+        if np.isscalar(idx):
+            idx += self.capacity
+            self.tree[idx] = val
+
+            idx //= 2
+            while idx >= 1:
+                self.tree[idx] = self.operation(self.tree[2 * idx], self.tree[2 * idx + 1])
+                idx //= 2
+            return
 
-    def __setitem__(self, idx: int, val: float):
-        """Set value in tree."""
-        idx += self.capacity
+        idx = np.asarray(idx, dtype=np.int64) + self.capacity
         self.tree[idx] = val
 
-        idx //= 2
-        while idx >= 1:
+        # all leaves sit at the same depth, so parents of one level are disjoint
+        for _ in range(self.depth):
+            idx = np.unique(idx // 2)
             self.tree[idx] = self.operation(self.tree[2 * idx], self.tree[2 * idx + 1])
-            idx //= 2
 
-    def __getitem__(self, idx: int) -> float:
+    def __getitem__(self, idx: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
         """Get real value in leaf node of tree."""
-        assert 0 <= idx < self.capacity
+        if np.isscalar(idx):
+            assert 0 <= idx < self.capacity
+            return self.tree[self.capacity + idx]
+
+        idx = np.asarray(idx, dtype=np.int64)
+        assert np.all((0 <= idx) & (idx < self.capacity))
 
         return self.tree[self.capacity + idx]
 
@@ -100,21 +126,39 @@ class SumSegmentTree(SegmentTree):
         """Returns arr[start] + ... + arr[end]."""
         return super(SumSegmentTree, self).operate(start, end)
 
-    def retrieve(self, upperbound: float) -> int:
-        """Find the highest index `i` about upper bound in the tree"""
+    def retrieve(self, upperbound: Union[float, np.ndarray]) -> Union[int, np.ndarray]:
+        """Find the highest index `i` about upper bound in the tree.
+
+        Accepts a single upper bound or an array of them; in the latter case the
+        whole batch descends the tree together, one level per step.
+        """
         # TODO: Check assert case and fix bug
-        assert 0 <= upperbound <= self.sum() + 1e-5, "upperbound: {}".format(upperbound)
+        if np.isscalar(upperbound):
+            assert 0 <= upperbound <= self.sum() + 1e-5, "upperbound: {}".format(upperbound)
+
+            idx = 1
 
-        idx = 1
+            while idx < self.capacity:  # while non-leaf
+                left = 2 * idx
+                right = left + 1
+                if self.tree[left] > upperbound:
+                    idx = 2 * idx
+                else:
+                    upperbound -= self.tree[left]
+                    idx = right
+            return idx - self.capacity
 
-        while idx < self.capacity:  # while non-leaf
+        upperbound = np.array(upperbound, dtype=np.float64)
+        assert np.all((0 <= upperbound) & (upperbound <= self.sum() + 1e-5)), "upperbound: {}".format(upperbound)
+
+        idx = np.ones(upperbound.shape, dtype=np.int64)
+
+        for _ in range(self.depth):  # descend one level per step
             left = 2 * idx
-            right = left + 1
-            if self.tree[left] > upperbound:
-                idx = 2 * idx
-            else:
-                upperbound -= self.tree[left]
-                idx = right
+            left_value = self.tree[left]
+            go_right = left_value <= upperbound
+            upperbound -= np.where(go_right, left_value, 0.0)
+            idx = left + go_right
         return idx - self.capacity
 
 
@@ -134,7 +178,7 @@ class MinSegmentTree(SegmentTree):
 
         """
         super(MinSegmentTree, self).__init__(
-            capacity=capacity, operation=min, init_value=float("inf")
+            capacity=capacity, operation=np.minimum, init_value=float("inf")
         )
 
     def min(self, start: int = 0, end: int = 0) -> float:
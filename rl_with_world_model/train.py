@@ -183,14 +183,14 @@ class AgentTrainer():
   def fine_tune(self):
 
     buffer = self.pri_buffer.sample_batch()
-    vision, proprioception, next_vision, next_proprioception, action, reward, done, weights, indices = buffer['vision'], \
-      buffer['proprioception'], buffer['next_vision'], buffer['next_proprioception'], buffer['action'], buffer['reward'], \
-        buffer['done'], buffer['weights'], buffer['indices']
-
-    vision = torch.FloatTensor(vision).to(self.device)
-    proprioception = torch.FloatTensor(proprioception).to(self.device)
-    next_vision = torch.FloatTensor(next_vision).to(self.device)
-    next_proprioception = torch.FloatTensor(next_proprioception).to(self.device)
+    obs, next_obs, action, reward, done, weights, indices = buffer['obs'], buffer['next_obs'], buffer['acts'], \
+      buffer['rews'], buffer['done'], buffer['weights'], buffer['indices']
+
+    vision = torch.FloatTensor(obs['frontview_image']).to(self.device)
+    next_vision = torch.FloatTensor(next_obs['frontview_image']).to(self.device)
+    # proprioception is the end effector position followed by its orientation
+    proprioception = torch.cat([torch.FloatTensor(obs['robot0_eef_pos']), torch.FloatTensor(obs['robot0_eef_quat'])], dim=-1).to(self.device)
+    next_proprioception = torch.cat([torch.FloatTensor(next_obs['robot0_eef_pos']), torch.FloatTensor(next_obs['robot0_eef_quat'])], dim=-1).to(self.device)
     action = torch.FloatTensor(action).to(self.device)
     reward = torch.FloatTensor(reward).to(self.device)
     done = torch.FloatTensor(done).to(self.device)
@@ -21,6 +21,7 @@ from typing import List, Optional, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, MSELoss
 
 from transformers.activations import ACT2FN
@@ -141,6 +142,8 @@ class Attention(nn.Module):
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
         self.pruned_heads = set()
+        # fused attention unless disabled in the config, only used without head_mask and output_attentions
+        self.use_sdpa = getattr(config, "use_sdpa", True)
 
     def prune_heads(self, heads):
         if len(heads) == 0:
@@ -160,6 +163,9 @@ class Attention(nn.Module):
         self.pruned_heads = self.pruned_heads.union(heads)
 
     def _attn(self, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
+        if self.use_sdpa and head_mask is None and not output_attentions:
+            return self._sdpa_attn(q, k, v, attention_mask)
+
         w = torch.matmul(q, k)
         if self.scale:
             w = w / (float(v.size(-1)) ** 0.5)
@@ -186,6 +192,27 @@ class Attention(nn.Module):
             outputs.append(w)
         return outputs
 
+    def _sdpa_attn(self, q, k, v, attention_mask=None):
+        # same result as _attn without materializing the scores when the kernel supports it
+        nd, ns = q.size(-2), k.size(-1)
+        causal = not self.is_cross_attention and nd > 1
+        if causal and (attention_mask is not None or nd != ns):
+            # is_causal aligns the mask to the top left, with a past the queries are the last nd positions,
+            # and it cannot be combined with the padding mask, so both are added into one float mask
+            mask = self.bias[:, :, ns - nd: ns, :ns].bool()
+            causal_mask = torch.where(mask, torch.zeros((), dtype=q.dtype, device=q.device), self.masked_bias.to(q.dtype))
+            attention_mask = causal_mask if attention_mask is None else causal_mask + attention_mask
+            causal = False
+
+        a = F.scaled_dot_product_attention(
+            q, k.transpose(-2, -1), v,
+            attn_mask=attention_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            is_causal=causal,
+            scale=None if self.scale else 1.0,  # None scales by 1/sqrt(head_features)
+        )
+        return [a]
+
     def merge_heads(self, x):
         x = x.permute(0, 2, 1, 3).contiguous()
         new_x_shape = x.size()[:-2] + (x.size(-2) * x.size(-1),)
@@ -50,19 +50,19 @@ class AgentTrainer():
 
     def update(self):
       sample = self.pri_buffer.sample_batch()
-      obs, action, reward, next_obs, done = sample['obs'], sample['act'], sample['rew'], sample['obs_next'], sample['terminated']
+      obs, action, reward, next_obs, done, indice = sample['obs'], sample['acts'], sample['rews'], sample['next_obs'], sample['done'], sample['indices']
 
       robot_state = [
           np.array(obs['robot0_eef_pos'], dtype=np.float32).flatten(),
           np.array(obs['robot0_eef_quat'], dtype=np.float32).flatten()
       ]
 
-      vision = np.array(obs['vision'], dtype=np.float32)
+      vision = np.array(obs['frontview_image'], dtype=np.float32)
       next_robot_state = [
           np.array(next_obs['robot0_eef_pos'], dtype=np.float32).flatten(),
           np.array(next_obs['robot0_eef_quat'], dtype=np.float32).flatten()
       ]
-      next_vision = np.array(next_obs['vision'], dtype=np.float32)
+      next_vision = np.array(next_obs['frontview_image'], dtype=np.float32)
 
       robot_state = np.concatenate(robot_state)
       next_robot_state = np.concatenate(next_robot_state)
@@ -72,7 +72,7 @@ class AgentTrainer():
       vision = torch.tensor(vision, dtype=torch.float32)
       next_vision = torch.tensor(next_vision, dtype=torch.float32)
 
-      action = action.to(self.device)
+      action = torch.FloatTensor(action).to(self.device)
 
       reward = torch.FloatTensor(reward).to(self.device)
       done = np.array(done)